@@ -0,0 +1,192 @@
+import argparse
+import os
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from comune import italian_timezone, scrivi_parquet
+
+# Cartella di default dell'archivio
+archivio_path = "archivio_trip_updates"
+
+#Chiave di una previsione all'interno di una partizione (service_date, route_id).
+#stop_sequence distingue i passaggi ripetuti alla stessa fermata nei percorsi circolari
+CHIAVE = ["trip_id", "stop_id", "stop_sequence"]
+
+#Indice per partizione con l'ultima previsione scritta per chiave, valido per entrambe le politiche
+#(il prefisso "_" lo esclude dalle letture del dataset)
+NOME_INDICE = "_previsioni.parquet"
+NOME_COMPATTATO = "part-compattata.parquet"
+
+#Ore dopo la mezzanotte della data di servizio oltre le quali non arrivano più previsioni e la partizione si compatta
+ORE_CHIUSURA = 30
+
+#Partizionamento hive con valori sempre stringa (evita che route_id '211' diventi intero)
+PARTIZIONAMENTO = ds.partitioning(
+    pa.schema([("service_date", pa.string()), ("route_id", pa.string())]), flavor="hive"
+)
+
+POLITICHE = ("ultima", "prima")
+
+
+#Data di servizio: start_date del viaggio se presente, altrimenti la data locale di arrivo
+def calcola_service_date(df):
+    start = pd.to_datetime(df["start_date"], format="%Y%m%d", errors="coerce").dt.strftime("%Y-%m-%d")
+    return start.fillna(df["arrival_date"])
+
+
+def _controlla_politica(politica):
+    if politica not in POLITICHE:
+        raise ValueError(f"Politica non valida: {politica} (ammesse: {', '.join(POLITICHE)})")
+
+
+#Una sola previsione per chiave: la più recente ('ultima') o la prima osservata ('prima')
+def deduplica(df, politica="ultima", chiave=CHIAVE):
+    _controlla_politica(politica)
+    df = df.sort_values("snapshot_ts", kind="stable")
+    return df.drop_duplicates(subset=chiave, keep="last" if politica == "ultima" else "first")
+
+
+def _percorso_partizione(radice, service_date, route_id):
+    return os.path.join(radice, f"service_date={service_date}", f"route_id={route_id}")
+
+
+def _parti(cartella):
+    return sorted(f for f in os.listdir(cartella) if f.endswith(".parquet") and not f.startswith(("_", ".")))
+
+
+PARTIZIONE = ["service_date", "route_id"]
+COLONNE_INDICE = CHIAVE + ["snapshot_ts", "arrival_time_utc"]
+
+
+#Previsioni già archiviate nelle partizioni indicate, lette dai loro indici in un'unica scansione
+def _previsioni_esistenti(radice, partizioni):
+    indici = [os.path.join(_percorso_partizione(radice, service_date, route_id), NOME_INDICE)
+              for service_date, route_id in partizioni]
+    indici = [indice for indice in indici if os.path.exists(indice)]
+    if not indici:
+        return None
+    dataset = ds.dataset(indici, format="parquet", partitioning=PARTIZIONAMENTO, partition_base_dir=radice)
+    return dataset.to_table().to_pandas()[PARTIZIONE + COLONNE_INDICE]
+
+
+#Righe che portano informazione nuova rispetto a quanto già archiviato
+def _righe_nuove(nuove, esistenti, politica):
+    if esistenti is None or esistenti.empty:
+        return nuove
+    chiave = PARTIZIONE + CHIAVE
+    confronto = nuove[chiave + ["arrival_time_utc"]].merge(
+        esistenti[chiave + ["arrival_time_utc"]], on=chiave, how="left", suffixes=("", "_archivio")
+    )
+    mancanti = confronto["arrival_time_utc_archivio"].isna()
+    if politica == "ultima":
+        #Una previsione già nota viene riscritta solo se l'orario di arrivo è cambiato
+        mancanti |= confronto["arrival_time_utc"] != confronto["arrival_time_utc_archivio"]
+    return nuove[mancanti.to_numpy()]
+
+
+#Unione di uno o più snapshot decodificati nell'archivio: le parti esistenti non vengono riscritte finché la
+#giornata di servizio è aperta, poi le partizioni chiuse sono compattate in un solo file
+def aggiungi_snapshot(dati, radice=archivio_path, politica="ultima", compatta=True):
+    _controlla_politica(politica)
+    df = dati.to_pandas() if isinstance(dati, pa.Table) else dati.copy()
+    if df.empty:
+        return 0
+
+    df["service_date"] = calcola_service_date(df)
+    df["route_id"] = df["route_id"].replace("", "sconosciuta").fillna("sconosciuta")
+    df = deduplica(df, politica, PARTIZIONE + CHIAVE)
+
+    #Confronto con l'archivio in un'unica join per tutte le partizioni toccate
+    partizioni = df[PARTIZIONE].drop_duplicates().itertuples(index=False, name=None)
+    esistenti = _previsioni_esistenti(radice, list(partizioni))
+    nuove = _righe_nuove(df, esistenti, politica)
+    if nuove.empty:
+        return 0
+
+    #Indici aggiornati: previsioni esistenti delle partizioni toccate più le nuove righe
+    indici = nuove[PARTIZIONE + COLONNE_INDICE]
+    if esistenti is not None:
+        toccate = esistenti.merge(nuove[PARTIZIONE].drop_duplicates(), on=PARTIZIONE)
+        indici = pd.concat([toccate, indici], ignore_index=True)
+    indici = deduplica(indici, "ultima", PARTIZIONE + CHIAVE).groupby(PARTIZIONE, sort=False)
+
+    for (service_date, route_id), gruppo in nuove.groupby(PARTIZIONE, sort=False):
+        cartella = _percorso_partizione(radice, service_date, route_id)
+        os.makedirs(cartella, exist_ok=True)
+        #Ogni unione aggiunge un nuovo file: le parti già scritte non vengono toccate
+        nome = f"part-{gruppo['snapshot_ts'].max():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.parquet"
+        pq.write_table(pa.Table.from_pandas(gruppo.drop(columns=PARTIZIONE), preserve_index=False),
+                       os.path.join(cartella, nome))
+        indice = indici.get_group((service_date, route_id))[COLONNE_INDICE]
+        scrivi_parquet(indice, os.path.join(cartella, NOME_INDICE))
+
+    if compatta:
+        compatta_archivio(radice, politica)
+    return len(nuove)
+
+
+#Partizione in un solo file con una previsione per chiave; le vecchie parti sono rimosse dopo la scrittura
+def compatta_partizione(cartella, politica="ultima"):
+    parti = _parti(cartella)
+    if parti in ([], [NOME_COMPATTATO]):
+        return 0
+    df = deduplica(ds.dataset([os.path.join(cartella, p) for p in parti], format="parquet").to_table().to_pandas(), politica)
+    scrivi_parquet(df, os.path.join(cartella, NOME_COMPATTATO))
+    for parte in parti:
+        if parte != NOME_COMPATTATO:
+            os.remove(os.path.join(cartella, parte))
+    return len(parti)
+
+
+#Compattazione delle partizioni con più parti la cui giornata di servizio è chiusa
+def compatta_archivio(radice=archivio_path, politica="ultima", adesso=None):
+    _controlla_politica(politica)
+    if not os.path.isdir(radice):
+        return 0
+    adesso = pd.Timestamp.now(tz=italian_timezone) if adesso is None else pd.Timestamp(adesso)
+    compattate = 0
+    for cartella_data in sorted(os.listdir(radice)):
+        if not cartella_data.startswith("service_date="):
+            continue
+        chiusura = pd.Timestamp(cartella_data.split("=", 1)[1], tz=italian_timezone) + pd.Timedelta(hours=ORE_CHIUSURA)
+        if adesso < chiusura:
+            continue
+        for cartella_linea in sorted(os.listdir(os.path.join(radice, cartella_data))):
+            cartella = os.path.join(radice, cartella_data, cartella_linea)
+            if os.path.isdir(cartella) and len(_parti(cartella)) > 1:
+                compatta_partizione(cartella, politica)
+                compattate += 1
+    return compattate
+
+
+#Lettura dell'archivio limitata alle partizioni richieste, con una previsione per evento di fermata
+def leggi_archivio(radice=archivio_path, date=None, linee=None, colonne=None, politica="ultima"):
+    _controlla_politica(politica)
+    dataset = ds.dataset(radice, format="parquet", partitioning=PARTIZIONAMENTO)
+    filtro = None
+    if date is not None:
+        filtro = ds.field("service_date").isin([str(d) for d in date])
+    if linee is not None:
+        filtro_linee = ds.field("route_id").isin([str(r) for r in linee])
+        filtro = filtro_linee if filtro is None else filtro & filtro_linee
+    if colonne is not None:
+        colonne = list(dict.fromkeys(["service_date", "route_id", "snapshot_ts"] + CHIAVE + list(colonne)))
+
+    df = dataset.to_table(columns=colonne, filter=filtro).to_pandas()
+    return deduplica(df, politica, ["service_date", "route_id"] + CHIAVE).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Unione di trip updates decodificati nell'archivio locale")
+    parser.add_argument("sorgenti", nargs="+", help="file Parquet prodotti da rome_trip_updates.py")
+    parser.add_argument("-a", "--archivio", default=archivio_path, help="cartella dell'archivio")
+    parser.add_argument("--politica", choices=POLITICHE, default="ultima",
+                        help="previsione da conservare per (trip_id, stop_id, stop_sequence)")
+    args = parser.parse_args()
+
+    for sorgente in args.sorgenti:
+        scritte = aggiungi_snapshot(pq.read_table(sorgente), args.archivio, args.politica, compatta=False)
+        print(f"{sorgente}: {scritte} nuove previsioni archiviate in {args.archivio}")
+    print(f"{compatta_archivio(args.archivio, args.politica)} partizioni di giornate chiuse compattate")
@@ -0,0 +1,177 @@
+import argparse
+import os
+import time
+from functools import cached_property
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from preprocessing_gtfs import COLONNE_STOP_TIMES, COLONNE_TRIPS, leggi_gtfs, leggi_gtfs_a_blocchi, orario_in_secondi
+
+#Cartella di default del bundle precompilato
+bundle_path = "gtfs_bundle"
+
+COLONNE_ROUTES = {
+    "route_id": pa.string(),
+    "agency_id": pa.string(),
+    "route_short_name": pa.string(),
+    "route_long_name": pa.string(),
+    "route_type": pa.int32(),
+}
+
+COLONNE_STOPS = {
+    "stop_id": pa.string(),
+    "stop_code": pa.string(),
+    "stop_name": pa.string(),
+    "stop_lat": pa.float64(),
+    "stop_lon": pa.float64(),
+}
+
+SCHEMA_TRIP_STOPS = pa.schema([
+    ("trip_id", pa.string()),
+    ("stop_id", pa.string()),
+    ("stop_sequence", pa.int32()),
+    ("arrival_time", pa.int32()),
+    ("departure_time", pa.int32()),
+])
+
+
+#Scrittura in formato Arrow IPC non compresso, leggibile con memory map senza copie
+def _scrivi_arrow(tabella, percorso):
+    with pa.OSFile(percorso, "wb") as sink:
+        with pa.ipc.new_file(sink, tabella.schema) as writer:
+            writer.write_table(tabella)
+
+
+def _leggi_arrow(percorso):
+    return pa.ipc.open_file(pa.memory_map(percorso, "r")).read_all()
+
+
+#Indice a offset: per ogni chiave (tabella già ordinata per chiave) la prima riga e quella successiva all'ultima
+def costruisci_indice(chiavi, nome_chiave):
+    n = len(chiavi)
+    if n == 0:
+        return pa.table({nome_chiave: pa.array([], pa.string()),
+                         "inizio": pa.array([], pa.int64()), "fine": pa.array([], pa.int64())})
+    chiavi = chiavi.combine_chunks() if isinstance(chiavi, pa.ChunkedArray) else chiavi
+    cambi = pc.not_equal(chiavi.slice(1), chiavi.slice(0, n - 1))
+    inizi = pa.concat_arrays([pa.array([0], pa.int64()),
+                              pc.add(pc.indices_nonzero(cambi), 1).cast(pa.int64())])
+    fini = pa.concat_arrays([inizi.slice(1), pa.array([n], pa.int64())])
+    return pa.table({nome_chiave: pc.take(chiavi, inizi), "inizio": inizi, "fine": fini})
+
+
+#stop_times dal Parquet di preprocessing_gtfs.py (orari già in secondi) oppure da stop_times.txt
+def _carica_stop_times(percorso):
+    if percorso.endswith(".parquet"):
+        return pq.read_table(percorso, columns=SCHEMA_TRIP_STOPS.names).cast(SCHEMA_TRIP_STOPS)
+    blocchi = []
+    for blocco in leggi_gtfs_a_blocchi(percorso, COLONNE_STOP_TIMES):
+        blocco = pa.Table.from_batches([blocco])
+        blocchi.append(pa.table({
+            "trip_id": blocco["trip_id"],
+            "stop_id": blocco["stop_id"],
+            "stop_sequence": blocco["stop_sequence"],
+            "arrival_time": orario_in_secondi(blocco["arrival_time"]),
+            "departure_time": orario_in_secondi(blocco["departure_time"]),
+        }, schema=SCHEMA_TRIP_STOPS))
+    return pa.concat_tables(blocchi) if blocchi else SCHEMA_TRIP_STOPS.empty_table()
+
+
+#Compilazione una tantum del feed statico nel bundle colonnare con gli indici linea→viaggi e viaggio→fermate
+def costruisci_bundle(cartella_dati, output_path=bundle_path, stop_times_path=None):
+    inizio = time.perf_counter()
+    os.makedirs(output_path, exist_ok=True)
+    if stop_times_path is None:
+        stop_times_path = f"{cartella_dati}/stop_times.txt"
+
+    routes = leggi_gtfs(f"{cartella_dati}/routes.txt", COLONNE_ROUTES)
+    stops = leggi_gtfs(f"{cartella_dati}/stops.txt", COLONNE_STOPS)
+    trips = leggi_gtfs(f"{cartella_dati}/trips.txt", COLONNE_TRIPS).sort_by([("route_id", "ascending"),
+                                                                           ("trip_id", "ascending")])
+    trip_stops = _carica_stop_times(stop_times_path).sort_by([("trip_id", "ascending"),
+                                                             ("stop_sequence", "ascending")])
+
+    _scrivi_arrow(routes, os.path.join(output_path, "routes.arrow"))
+    _scrivi_arrow(stops, os.path.join(output_path, "stops.arrow"))
+    _scrivi_arrow(trips, os.path.join(output_path, "trips.arrow"))
+    _scrivi_arrow(trip_stops, os.path.join(output_path, "trip_stops.arrow"))
+    _scrivi_arrow(costruisci_indice(trips["route_id"], "route_id"), os.path.join(output_path, "indice_linee.arrow"))
+    _scrivi_arrow(costruisci_indice(trip_stops["trip_id"], "trip_id"), os.path.join(output_path, "indice_viaggi.arrow"))
+
+    return {
+        "output": output_path,
+        "routes": routes.num_rows,
+        "trips": trips.num_rows,
+        "stops": stops.num_rows,
+        "stop_times": trip_stops.num_rows,
+        "secondi": time.perf_counter() - inizio,
+    }
+
+
+#Accesso pigro al bundle: ogni tabella viene mappata in memoria solo al primo utilizzo
+class BundleGTFS:
+
+    def __init__(self, percorso=bundle_path):
+        if not os.path.isdir(percorso):
+            raise FileNotFoundError(
+                f"Bundle GTFS non trovato in '{percorso}': eseguire prima 'python bundle_gtfs.py <cartella_gtfs>'"
+            )
+        self.percorso = percorso
+
+    def _tabella(self, nome):
+        return _leggi_arrow(os.path.join(self.percorso, f"{nome}.arrow"))
+
+    @cached_property
+    def routes(self):
+        return self._tabella("routes")
+
+    @cached_property
+    def trips(self):
+        return self._tabella("trips")
+
+    @cached_property
+    def stops(self):
+        return self._tabella("stops")
+
+    @cached_property
+    def trip_stops(self):
+        return self._tabella("trip_stops")
+
+    @cached_property
+    def indice_linee(self):
+        return self._tabella("indice_linee")
+
+    @cached_property
+    def indice_viaggi(self):
+        return self._tabella("indice_viaggi")
+
+    #Righe contigue delle chiavi richieste, a partire dall'indice a offset
+    def _righe(self, tabella, indice, nome_chiave, chiavi):
+        posizioni = pc.index_in(pa.array(list(chiavi), pa.string()), value_set=indice[nome_chiave])
+        posizioni = posizioni.filter(pc.is_valid(posizioni))
+        inizi = pc.take(indice["inizio"], posizioni).to_pylist()
+        fini = pc.take(indice["fine"], posizioni).to_pylist()
+        if not inizi:
+            return tabella.schema.empty_table()
+        return pa.concat_tables([tabella.slice(i, f - i) for i, f in zip(inizi, fini)])
+
+    #Viaggi delle linee richieste (slice zero-copy della tabella trips)
+    def trips_delle_linee(self, route_ids):
+        return self._righe(self.trips, self.indice_linee, "route_id", route_ids)
+
+    #Fermate ordinate per stop_sequence dei viaggi richiesti
+    def fermate_dei_viaggi(self, trip_ids):
+        return self._righe(self.trip_stops, self.indice_viaggi, "trip_id", trip_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compilazione del GTFS statico in un bundle Arrow per la dashboard")
+    parser.add_argument("cartella", help="cartella con routes.txt, trips.txt, stops.txt e stop_times.txt")
+    parser.add_argument("-o", "--output", default=bundle_path, help="cartella del bundle")
+    parser.add_argument("--stop-times", default=None,
+                        help="stop_times alternativo (es. il Parquet prodotto da preprocessing_gtfs.py)")
+    args = parser.parse_args()
+
+    stats = costruisci_bundle(args.cartella, args.output, args.stop_times)
+    print(f"Bundle salvato in {stats['output']}: {stats['routes']} linee, {stats['trips']} viaggi, "
+          f"{stats['stops']} fermate, {stats['stop_times']} orari in {stats['secondi']:.2f} s")
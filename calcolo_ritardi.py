@@ -0,0 +1,184 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from archivio_trip_updates import calcola_service_date, deduplica, leggi_archivio
+from comune import italian_timezone
+
+#Soglia dei ritardi consistenti (5 minuti)
+SOGLIA_RITARDO = 5 * 60
+
+#Colonne dell'orario programmato usate nella join (output di preprocessing_gtfs.py)
+COLONNE_ORARI = ["trip_id", "stop_id", "route_id", "stop_sequence", "arrival_time", "departure_time", "shape_dist_traveled"]
+
+_MEZZA_GIORNATA = 12 * 3600
+_GIORNATA = 24 * 3600
+
+
+#Trip updates da un Parquet di rome_trip_updates.py o dalla cartella dell'archivio, una previsione per fermata
+def carica_trip_updates(percorso, date=None):
+    if os.path.isdir(percorso):
+        return leggi_archivio(percorso, date=date)
+    df = pq.read_table(percorso).to_pandas()
+    df["service_date"] = calcola_service_date(df)
+    if date is not None:
+        df = df[df["service_date"].isin([str(d) for d in date])]
+    if "snapshot_ts" in df.columns:
+        chiave = ["service_date", "trip_id", "stop_id"] + (["stop_sequence"] if "stop_sequence" in df.columns else [])
+        df = deduplica(df, "ultima", chiave)
+    return df.reset_index(drop=True)
+
+
+#Inizio della giornata di servizio GTFS: mezzogiorno locale meno 12 ore (corretto anche nei giorni del cambio d'ora)
+def inizio_giornata_servizio(service_date):
+    codici, date = pd.factorize(pd.Series(service_date, dtype="string"))
+    mezzogiorno = pd.to_datetime(date, format="%Y-%m-%d") + pd.Timedelta(hours=12)
+    riferimento = mezzogiorno.tz_localize(italian_timezone) - pd.Timedelta(hours=12)
+    epoch = riferimento.as_unit("s").asi8
+    return epoch[codici]
+
+
+#Orario di arrivo in tempo reale espresso in secondi dall'inizio della giornata di servizio
+def secondi_giornata_servizio(arrival_time_utc, service_date):
+    arrivo = pd.DatetimeIndex(arrival_time_utc).as_unit("s").asi8
+    return arrivo - inizio_giornata_servizio(service_date)
+
+
+#Ritardo in secondi rispetto all'orario di arrivo programmato (anche oltre le 24:00:00)
+def ritardo_secondi(arrivo_reale, arrivo_programmato):
+    ritardo = np.asarray(arrivo_reale, dtype=np.int64) - np.asarray(arrivo_programmato, dtype=np.int64)
+    #Senza start_date la giornata di servizio è stimata dalla data di arrivo: si riporta il ritardo entro ±12 ore
+    ritardo = np.where(ritardo > _MEZZA_GIORNATA, ritardo - _GIORNATA, ritardo)
+    ritardo = np.where(ritardo < -_MEZZA_GIORNATA, ritardo + _GIORNATA, ritardo)
+    return ritardo.astype(np.int32)
+
+
+#Join in memoria tra previsioni e orario programmato, con il ritardo in secondi
+def calcola_ritardi(trip_updates, orari):
+    #Come nella vecchia join: _x orario reale (HH:MM:SS locale), _y orario programmato (secondi)
+    reali = trip_updates.drop(columns=["route_id"], errors="ignore")
+    reali = reali.rename(columns={"arrival_time": "arrival_time_x"})
+    if "service_date" not in reali.columns:
+        reali = reali.assign(service_date=calcola_service_date(reali))
+    programmati = orari[[c for c in COLONNE_ORARI if c in orari.columns]].rename(columns={"arrival_time": "arrival_time_y"})
+
+    #Chiavi con lo stesso tipo su entrambi i lati (le categoriche con categorie diverse rallentano il merge)
+    reali = reali.astype({"trip_id": "string", "stop_id": "string"})
+    programmati = programmati.astype({"trip_id": "string", "stop_id": "string"})
+
+    #Con stop_sequence la join distingue i passaggi ripetuti alla stessa fermata (percorsi circolari);
+    #solo le previsioni senza sequenza (0 o assente nel feed) sono unite sulla sola fermata
+    if "stop_sequence" not in reali.columns or "stop_sequence" not in programmati.columns:
+        df = reali.drop(columns=["stop_sequence"], errors="ignore").merge(programmati, on=["trip_id", "stop_id"], how="inner")
+    else:
+        con_sequenza = reali["stop_sequence"].fillna(0).to_numpy() > 0
+        programmati = programmati.astype({"stop_sequence": "int32"})
+        df = reali[con_sequenza].astype({"stop_sequence": "int32"}).merge(
+            programmati, on=["trip_id", "stop_id", "stop_sequence"], how="inner"
+        )
+        if not con_sequenza.all():
+            senza = reali[~con_sequenza].drop(columns=["stop_sequence"])
+            df = pd.concat([df, senza.merge(programmati, on=["trip_id", "stop_id"], how="inner")], ignore_index=True)
+
+    df["arrival_time_s"] = secondi_giornata_servizio(df["arrival_time_utc"], df["service_date"])
+    df["delay_s"] = ritardo_secondi(df["arrival_time_s"], df["arrival_time_y"])
+    return df
+
+
+def filtra_ritardi_consistenti(df, soglia=SOGLIA_RITARDO):
+    return df[df["delay_s"] > soglia]
+
+
+#Formattazione vettoriale in [-]HH:MM:SS, da usare solo per la visualizzazione
+def formatta_ritardo(secondi):
+    secondi = pd.Series(secondi)
+    valori = secondi.fillna(0).to_numpy().astype(np.int64)
+    assoluti = np.abs(valori)
+    parti = [
+        pc.utf8_lpad(pa.array(p).cast(pa.string()), width=2, padding="0")
+        for p in (assoluti // 3600, assoluti % 3600 // 60, assoluti % 60)
+    ]
+    segno = pa.array(np.where(valori < 0, "-", ""))
+    testo = pc.binary_join_element_wise(segno, pc.binary_join_element_wise(*parti, ":"), "")
+    return pd.Series(testo.to_numpy(zero_copy_only=False), index=secondi.index)
+
+
+#Colonne compatibili con il vecchio ritardi_consistenti.txt (delay come testo HH:MM:SS)
+def per_esportazione(df):
+    return df.assign(delay=formatta_ritardo(df["delay_s"]))
+
+
+#Calcolo completo da file: tutti i ritardi e quelli consistenti in Parquet. Il vecchio formato testo si scrive
+#solo su richiesta (testo=True): la formattazione del ritardo occupa gran parte del tempo del calcolo
+def esegui_calcolo(trip_updates_path, orari_path, output=".", testo=False):
+    ritardi = calcola_ritardi(carica_trip_updates(trip_updates_path), pq.read_table(orari_path).to_pandas())
+    ritardi.to_parquet(os.path.join(output, "ritardi.parquet"), index=False)
+    consistenti = filtra_ritardi_consistenti(ritardi)
+    consistenti.to_parquet(os.path.join(output, "ritardi_consistenti.parquet"), index=False)
+    if testo:
+        per_esportazione(consistenti).to_csv(os.path.join(output, "ritardi_consistenti.txt"), index=False, sep=",")
+    return {"eventi": len(ritardi), "consistenti": len(consistenti)}
+
+
+#Dati sintetici per misurare il throughput su un singolo core
+def dati_benchmark(n_eventi, n_fermate_per_viaggio=40, seed=0):
+    rng = np.random.default_rng(seed)
+    n_viaggi = max(n_eventi // n_fermate_per_viaggio, 1)
+    trip_id = np.repeat(np.arange(n_viaggi), n_fermate_per_viaggio)
+    sequenza = np.tile(np.arange(1, n_fermate_per_viaggio + 1), n_viaggi)
+    stop_id = (trip_id * 7 + sequenza) % 9000
+    partenza = rng.integers(5 * 3600, 25 * 3600, n_viaggi)
+    programmato = (np.repeat(partenza, n_fermate_per_viaggio) + sequenza * 90).astype(np.int32)
+
+    orari = pd.DataFrame({
+        "trip_id": pd.array(trip_id.astype(str), dtype="string"),
+        "stop_id": pd.array(stop_id.astype(str), dtype="string"),
+        "route_id": pd.array((trip_id % 400).astype(str), dtype="string"),
+        "stop_sequence": sequenza.astype(np.int32),
+        "arrival_time": programmato,
+        "departure_time": programmato,
+        "shape_dist_traveled": (sequenza * 300).astype(np.float32),
+    })
+    inizio = pd.Timestamp("2025-02-10", tz=italian_timezone).as_unit("s").value // 10**9
+    reale = inizio + programmato + rng.integers(-120, 900, len(programmato))
+    trip_updates = pd.DataFrame({
+        "trip_id": orari["trip_id"],
+        "stop_id": orari["stop_id"],
+        "stop_sequence": orari["stop_sequence"],
+        "service_date": pd.array(["2025-02-10"] * len(orari), dtype="string"),
+        "arrival_time_utc": pd.to_datetime(reale, unit="s", utc=True),
+    })
+    return trip_updates, orari
+
+
+def benchmark(n_eventi=2_000_000):
+    trip_updates, orari = dati_benchmark(n_eventi)
+    inizio = time.perf_counter()
+    df = calcola_ritardi(trip_updates, orari)
+    durata = time.perf_counter() - inizio
+    return {"eventi": len(df), "secondi": durata, "eventi_al_secondo": len(df) / durata}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calcolo dei ritardi rispetto all'orario programmato")
+    parser.add_argument("trip_updates", nargs="?", help="Parquet di rome_trip_updates.py o cartella dell'archivio")
+    parser.add_argument("orari", nargs="?", help="Parquet prodotto da preprocessing_gtfs.py")
+    parser.add_argument("-o", "--output", default=".", help="cartella di output")
+    parser.add_argument("--testo", action="store_true",
+                        help="salva anche ritardi_consistenti.txt con il ritardo formattato (per i notebook)")
+    parser.add_argument("--benchmark", type=int, metavar="N_EVENTI", default=None,
+                        help="misura il throughput su N eventi sintetici invece di elaborare i file")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        stats = benchmark(args.benchmark)
+        print(f"{stats['eventi']} eventi in {stats['secondi']:.2f} s ({stats['eventi_al_secondo']:,.0f} eventi/s)")
+    else:
+        if not args.trip_updates or not args.orari:
+            parser.error("servono i percorsi di trip_updates e orari (oppure --benchmark)")
+        stats = esegui_calcolo(args.trip_updates, args.orari, args.output, args.testo)
+        print(f"{stats['eventi']} eventi, {stats['consistenti']} con ritardo superiore a 5 minuti salvati in: {args.output}")
@@ -0,0 +1,24 @@
+import json
+import os
+
+#Fuso orario italiano
+italian_timezone = "Europe/Rome"
+
+
+#Scrittura atomica: il contenuto va in un file temporaneo nascosto (il prefisso "." lo esclude dalle letture dei
+#dataset Parquet) che poi sostituisce il file, così chi legge vede sempre la versione precedente o quella nuova
+def scrivi_atomico(percorso, scrivi):
+    temporaneo = os.path.join(os.path.dirname(percorso), "." + os.path.basename(percorso) + ".tmp")
+    scrivi(temporaneo)
+    os.replace(temporaneo, percorso)
+
+
+def scrivi_parquet(df, percorso):
+    scrivi_atomico(percorso, lambda temporaneo: df.to_parquet(temporaneo, index=False))
+
+
+def scrivi_json(dati, percorso):
+    def scrivi(temporaneo):
+        with open(temporaneo, "w") as f:
+            json.dump(dati, f, indent=1, sort_keys=True)
+    scrivi_atomico(percorso, scrivi)
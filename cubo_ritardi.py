@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from comune import italian_timezone, scrivi_json
+
+# Cartella di default del cubo
+cubo_path = "cubo_ritardi"
+
+#Estremi (in minuti) dell'istogramma usato come sketch dei quantili, più un bin per coda
+BORDI_MINUTI = np.array([-60, -30, -15, -10, -5, -2, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
+                         12, 15, 20, 25, 30, 40, 50, 60, 90, 120], dtype=np.float64)
+BORDI = BORDI_MINUTI * 60
+N_BIN = len(BORDI) + 1
+
+#Livelli materializzati: il dettaglio per fermata e il rollup per linea, usato quando stop_id non serve
+LIVELLI = {
+    "fermate": ["route_id", "stop_id", "hour"],
+    "linee": ["route_id", "hour"],
+}
+
+#Dimensioni derivate dalla data di servizio in fase di interrogazione
+DIMENSIONI_DERIVATE = ("day_of_week", "week")
+
+PARTIZIONAMENTO = ds.partitioning(pa.schema([("service_date", pa.string())]), flavor="hive")
+
+#Firma della sorgente da cui è stata costruita ogni giornata (il prefisso "_" la esclude dalle letture del dataset)
+NOME_FIRME = "_firme_sorgente.json"
+
+
+def _bin(delay_s):
+    return np.searchsorted(BORDI, delay_s, side="right")
+
+
+#Statistiche additive (conteggio, somma, somma dei quadrati, min, max, istogramma) per ogni cella
+def aggrega(df, dimensioni):
+    delay = df["delay_s"].to_numpy(dtype=np.float64)
+    codici, celle = pd.MultiIndex.from_frame(df[dimensioni]).factorize()
+    n_celle = len(celle)
+
+    istogramma = np.zeros((n_celle, N_BIN), dtype=np.uint32)
+    np.add.at(istogramma, (codici, _bin(delay)), 1)
+    n = np.bincount(codici, minlength=n_celle)
+    somma = np.bincount(codici, weights=delay, minlength=n_celle)
+    somma_quadrati = np.bincount(codici, weights=delay * delay, minlength=n_celle)
+    minimo = np.full(n_celle, np.inf)
+    massimo = np.full(n_celle, -np.inf)
+    np.minimum.at(minimo, codici, delay)
+    np.maximum.at(massimo, codici, delay)
+
+    risultato = celle.to_frame(index=False, name=dimensioni)
+    risultato["n"] = n.astype(np.int64)
+    risultato["somma"] = somma
+    risultato["somma_quadrati"] = somma_quadrati
+    risultato["min"] = minimo
+    risultato["max"] = massimo
+    risultato["istogramma"] = list(istogramma)
+    return risultato
+
+
+def _schema(dimensioni):
+    campi = [(d, pa.int8() if d == "hour" else pa.string()) for d in dimensioni]
+    return pa.schema(campi + [
+        ("n", pa.int64()),
+        ("somma", pa.float64()),
+        ("somma_quadrati", pa.float64()),
+        ("min", pa.float64()),
+        ("max", pa.float64()),
+        ("istogramma", pa.list_(pa.uint32(), N_BIN)),
+    ])
+
+
+#Ora locale dell'arrivo reale, come nei notebook (ora dell'orologio, non della giornata di servizio)
+def ora_locale(df):
+    if "arrival_time_utc" in df.columns:
+        return pd.DatetimeIndex(df["arrival_time_utc"]).tz_convert(italian_timezone).hour.to_numpy()
+    return pd.to_numeric(df["arrival_time_x"].str.slice(0, 2), errors="coerce").to_numpy()
+
+
+def _leggi_giornata(sorgente, service_date, intervallo):
+    colonne = ["route_id", "stop_id", "service_date", "delay_s", "arrival_time_utc"]
+    tabella = ds.dataset(sorgente, format="parquet").to_table(
+        columns=colonne, filter=ds.field("service_date") == service_date
+    )
+    df = tabella.to_pandas()
+    df = df[df["delay_s"].between(*intervallo)]
+    return df.assign(hour=ora_locale(df).astype(np.int8))
+
+
+#Costruzione delle partizioni di una giornata (eseguita nei processi figli)
+def costruisci_giornata(sorgente, radice, service_date, intervallo=(-3600, 7200)):
+    df = _leggi_giornata(sorgente, service_date, intervallo)
+    for livello, dimensioni in LIVELLI.items():
+        cartella = os.path.join(radice, f"livello={livello}", f"service_date={service_date}")
+        tabella = pa.Table.from_pandas(aggrega(df, dimensioni), schema=_schema(dimensioni), preserve_index=False)
+        #Scrittura in una cartella temporanea nascosta (il prefisso "." la esclude dalle letture del dataset), poi la
+        #vecchia cartella viene spostata da parte e sostituita: un'interrogazione concorrente non vede partizioni parziali
+        padre, nome = os.path.split(cartella)
+        temporanea, vecchia = os.path.join(padre, "." + nome + ".tmp"), os.path.join(padre, "." + nome + ".old")
+        for residua in (temporanea, vecchia):
+            shutil.rmtree(residua, ignore_errors=True)
+        os.makedirs(temporanea)
+        pq.write_table(tabella, os.path.join(temporanea, "part.parquet"))
+        if os.path.isdir(cartella):
+            os.rename(cartella, vecchia)
+        os.replace(temporanea, cartella)
+        shutil.rmtree(vecchia, ignore_errors=True)
+    return service_date, len(df)
+
+
+def date_nel_cubo(radice=cubo_path):
+    cartella = os.path.join(radice, "livello=linee")
+    if not os.path.isdir(cartella):
+        return set()
+    return {nome.split("=", 1)[1] for nome in os.listdir(cartella)
+            if nome.startswith("service_date=")}
+
+
+#Firma di ogni giornata della sorgente: numero di eventi e somma dei ritardi (cambia se arrivano nuovi eventi
+#o se la giornata viene ricalcolata)
+def firme_sorgente(sorgente):
+    df = ds.dataset(sorgente, format="parquet").to_table(columns=["service_date", "delay_s"]).to_pandas()
+    firme = df.groupby("service_date")["delay_s"].agg(["size", "sum"])
+    return {str(d): [int(n), int(somma)] for d, (n, somma) in firme.iterrows()}
+
+
+def leggi_firme(radice=cubo_path):
+    percorso = os.path.join(radice, NOME_FIRME)
+    if not os.path.exists(percorso):
+        return {}
+    with open(percorso) as f:
+        return json.load(f)
+
+
+#Aggiornamento incrementale: vengono costruite in parallelo le giornate assenti dal cubo e quelle la cui sorgente
+#è cambiata dall'ultima costruzione (nuovi eventi della stessa giornata)
+def aggiorna_cubo(sorgente, radice=cubo_path, date=None, ricostruisci=False, processi=None, intervallo=(-3600, 7200)):
+    inizio = time.perf_counter()
+    firme = firme_sorgente(sorgente)
+    if date is not None:
+        firme = {d: f for d, f in firme.items() if d in {str(d) for d in date}}
+    presenti = date_nel_cubo(radice)
+    costruite = leggi_firme(radice)
+    da_costruire = sorted(d for d, firma in firme.items()
+                          if ricostruisci or d not in presenti or costruite.get(d) != firma)
+
+    eventi = 0
+    if da_costruire:
+        with ProcessPoolExecutor(max_workers=processi) as pool:
+            futures = [pool.submit(costruisci_giornata, sorgente, radice, d, intervallo) for d in da_costruire]
+            for future in futures:
+                eventi += future.result()[1]
+        scrivi_json({**costruite, **{d: firme[d] for d in da_costruire}}, os.path.join(radice, NOME_FIRME))
+
+    return {"giornate": da_costruire, "eventi": eventi, "secondi": time.perf_counter() - inizio}
+
+
+def _aggiungi_derivate(df):
+    date = pd.to_datetime(df["service_date"], format="%Y-%m-%d")
+    df["day_of_week"] = date.dt.dayofweek.astype(np.int8)
+    df["week"] = (date - pd.to_timedelta(date.dt.dayofweek, unit="D")).dt.strftime("%Y-%m-%d")
+    return df
+
+
+#Quantili approssimati interpolando linearmente all'interno dei bin dell'istogramma
+def quantili_da_istogramma(istogrammi, minimi, massimi, q):
+    cumulata = np.cumsum(istogrammi, axis=1)
+    totale = cumulata[:, -1]
+    bordi_inferiori = np.concatenate([[-np.inf], BORDI])
+    bordi_superiori = np.concatenate([BORDI, [np.inf]])
+    risultato = np.full(len(istogrammi), np.nan)
+    validi = totale > 0
+    if not validi.any():
+        return risultato
+    obiettivo = q * totale[validi]
+    righe = np.nonzero(validi)[0]
+    indice = (cumulata[validi] < obiettivo[:, None]).sum(axis=1)
+    precedente = np.where(indice > 0, cumulata[righe, np.maximum(indice - 1, 0)], 0)
+    nel_bin = istogrammi[righe, indice]
+    basso = np.maximum(bordi_inferiori[indice], minimi[righe])
+    alto = np.minimum(bordi_superiori[indice], massimi[righe])
+    frazione = np.where(nel_bin > 0, (obiettivo - precedente) / np.maximum(nel_bin, 1), 0)
+    risultato[righe] = basso + frazione * (alto - basso)
+    return risultato
+
+
+#Interrogazione del cubo: statistiche dei ritardi (in secondi) per le dimensioni richieste
+def interroga_cubo(radice=cubo_path, per=("route_id", "hour"), date=None, linee=None, ore=None,
+                   giorni_settimana=None, quantili=(0.5, 0.9)):
+    per = list(per)
+    livello = "fermate" if "stop_id" in per else "linee"
+    filtri = []
+    if date is not None:
+        filtri.append(ds.field("service_date").isin([str(d) for d in date]))
+    if linee is not None:
+        filtri.append(ds.field("route_id").isin([str(r) for r in linee]))
+    if ore is not None:
+        filtri.append(ds.field("hour").isin([int(o) for o in ore]))
+    filtro = None
+    for f in filtri:
+        filtro = f if filtro is None else filtro & f
+
+    dataset = ds.dataset(os.path.join(radice, f"livello={livello}"), format="parquet", partitioning=PARTIZIONAMENTO)
+    colonne = ["service_date", "route_id", "hour", "n", "somma", "somma_quadrati", "min", "max", "istogramma"]
+    if livello == "fermate":
+        colonne.insert(2, "stop_id")
+    tabella = dataset.to_table(columns=colonne, filter=filtro)
+    istogrammi = tabella["istogramma"].combine_chunks().flatten().to_numpy().reshape(-1, N_BIN)
+    df = tabella.drop_columns(["istogramma"]).to_pandas()
+
+    if any(d in DIMENSIONI_DERIVATE for d in per) or giorni_settimana is not None:
+        df = _aggiungi_derivate(df)
+    if giorni_settimana is not None:
+        maschera = df["day_of_week"].isin(list(giorni_settimana)).to_numpy()
+        df, istogrammi = df[maschera], istogrammi[maschera]
+
+    if per:
+        codici, celle = pd.MultiIndex.from_frame(df[per]).factorize()
+        risultato = celle.to_frame(index=False, name=per)
+    else:
+        codici, risultato = np.zeros(len(df), dtype=np.int64), pd.DataFrame(index=[0])
+    n_celle = len(risultato)
+
+    n = np.bincount(codici, weights=df["n"].to_numpy(), minlength=n_celle)
+    somma = np.bincount(codici, weights=df["somma"].to_numpy(), minlength=n_celle)
+    somma_quadrati = np.bincount(codici, weights=df["somma_quadrati"].to_numpy(), minlength=n_celle)
+    minimo = np.full(n_celle, np.inf)
+    massimo = np.full(n_celle, -np.inf)
+    np.minimum.at(minimo, codici, df["min"].to_numpy())
+    np.maximum.at(massimo, codici, df["max"].to_numpy())
+    istogramma = np.zeros((n_celle, N_BIN), dtype=np.int64)
+    np.add.at(istogramma, codici, istogrammi)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        media = somma / n
+        #Varianza campionaria (ddof=1), come pandas
+        varianza = np.maximum(somma_quadrati - n * media ** 2, 0) / (n - 1)
+    risultato["n"] = n.astype(np.int64)
+    risultato["media_s"] = media
+    risultato["std_s"] = np.sqrt(varianza)
+    risultato["min_s"] = minimo
+    risultato["max_s"] = massimo
+    for q in quantili:
+        risultato[f"q{int(round(q * 100))}_s"] = quantili_da_istogramma(istogramma, minimo, massimo, q)
+    return risultato[risultato["n"] > 0].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Costruzione incrementale del cubo dei ritardi")
+    parser.add_argument("sorgente", help="Parquet dei ritardi prodotto da calcolo_ritardi.py")
+    parser.add_argument("-c", "--cubo", default=cubo_path, help="cartella del cubo")
+    parser.add_argument("-p", "--processi", type=int, default=None, help="numero di processi (default: tutti i core)")
+    parser.add_argument("--ricostruisci", action="store_true", help="ricostruisce anche le giornate invariate")
+    args = parser.parse_args()
+
+    stats = aggiorna_cubo(args.sorgente, args.cubo, ricostruisci=args.ricostruisci, processi=args.processi)
+    print(f"{len(stats['giornate'])} giornate aggiunte o aggiornate nel cubo ({stats['eventi']} eventi) in {stats['secondi']:.2f} s")
@@ -1,51 +1,78 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import folium
 from streamlit_folium import st_folium
 import matplotlib.pyplot as plt
 import seaborn as sns
-import requests
-import io
+from bundle_gtfs import BundleGTFS, bundle_path
+from mappa_fermate import fermate_delle_linee, genera_mappa, route_id_gtfs
+from cubo_ritardi import cubo_path, date_nel_cubo, interroga_cubo
+from ottimizzatore import PREFISSO_OUTPUT, ultimo_risultato
 
 # ========== Funzioni di supporto ==========
 
-@st.cache_data
-def carica_dataset_gtfs():
-    routes = pd.read_csv("routes.txt", dtype=str, low_memory=False)
-    trips = pd.read_csv("trips.txt", dtype=str, low_memory=False)
-    stops = pd.read_csv("stops.txt", dtype=str, low_memory=False)
-    return routes, trips, stops
-
-@st.cache_data
-def carica_stop_times(file_id):
-    url = f"https://drive.google.com/uc?export=download&id={file_id}"
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    return pd.read_parquet(io.BytesIO(response.content))
+# Bundle GTFS precompilato con "python bundle_gtfs.py <cartella_gtfs>": le tabelle sono mappate in memoria al primo uso
+@st.cache_resource
+def carica_bundle_gtfs():
+    return BundleGTFS(bundle_path)
 
 def filtra_routes(routes, dashboard_ids):
     ids_gtfs = [x.replace("Linea ", "").strip() for x in dashboard_ids]
-    return routes[(routes['agency_id'] == 'OP1') & (routes['route_type'] == '3') & (routes['route_id'].isin(ids_gtfs))]
-
-def genera_mappa_fermate(trips, stop_times, stops, ottimizzate_df):
-    palette = px.colors.qualitative.Set3
-    fermate = pd.DataFrame()
-    ottimizzate_df['route_id_gtfs'] = ottimizzate_df['route_id'].str.replace("Linea ", "").str.strip()
-    for i, row in ottimizzate_df.iterrows():
-        match = trips[trips['route_id'] == row['route_id_gtfs']]
-        if not match.empty:
-            trip_id = match['trip_id'].iloc[0]
-            stops_trip = stop_times[stop_times['trip_id'] == trip_id]
-            stop_ids = stops_trip['stop_id'].unique()
-            fermate_linea = stops[stops['stop_id'].isin(stop_ids)].copy()
-            fermate_linea['route_id'] = row['route_id']
-            fermate_linea['color'] = palette[i % len(palette)]
-            fermate = pd.concat([fermate, fermate_linea], ignore_index=True)
-    return fermate
+    return routes[(routes['agency_id'] == 'OP1') & (routes['route_type'] == 3) & (routes['route_id'].isin(ids_gtfs))]
+
+# Fermate di tutte le linee selezionate risolte con un'unica join sul bundle (una riga per linea e fermata)
+def genera_mappa_fermate(bundle, ottimizzate_df):
+    routes_filt = filtra_routes(bundle.routes.to_pandas(), ottimizzate_df['route_id'].unique())
+    etichette = ottimizzate_df['route_id'].drop_duplicates()
+    etichette = etichette[route_id_gtfs(etichette).isin(routes_filt['route_id']).to_numpy()]
+    return fermate_delle_linee(bundle, etichette)
+
+GIORNI = ['Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì', 'Sabato', 'Domenica']
+MESI = ['gennaio', 'febbraio', 'marzo', 'aprile', 'maggio', 'giugno', 'luglio', 'agosto',
+        'settembre', 'ottobre', 'novembre', 'dicembre']
+
+# Output del modello prescrittivo (python ottimizzatore.py): solo l'ultima esecuzione, le precedenti non si sommano
+@st.cache_data(ttl=600)
+def carica_ottimizzazioni():
+    file = ultimo_risultato()
+    if file is None:
+        raise FileNotFoundError(f"nessun file {PREFISSO_OUTPUT}*.csv trovato")
+    df_opt = pd.read_csv(file, dtype={'route_id': str})
+    if df_opt.empty:
+        raise ValueError(f"nessuna corsa extra in {file}")
+    df_opt["fascia_oraria"] = f"{df_opt['hour'].min():02d}-{df_opt['hour'].max():02d}"
+    df_opt['hour'] = df_opt['hour'].astype(str)
+    return df_opt
+
+# Settimane presenti nel cubo dei ritardi, con etichetta tipo "10-14 febbraio"
+@st.cache_data(ttl=600)
+def settimane_cubo():
+    date = pd.to_datetime(pd.Series(sorted(date_nel_cubo(cubo_path))), format="%Y-%m-%d")
+    settimane = {}
+    for _, giorni in date.groupby(date - pd.to_timedelta(date.dt.dayofweek, unit="D")):
+        primo, ultimo = giorni.min(), giorni.max()
+        if primo.month == ultimo.month:
+            etichetta = f"{primo.day}-{ultimo.day} {MESI[ultimo.month - 1]}"
+        else:
+            etichetta = f"{primo.day} {MESI[primo.month - 1]}-{ultimo.day} {MESI[ultimo.month - 1]}"
+        settimane[etichetta] = tuple(giorni.dt.strftime("%Y-%m-%d"))
+    return settimane
+
+# Ritardi medi (minuti) per linea, giorno e ora di una settimana, letti dal rollup per linea del cubo
+@st.cache_data(ttl=600)
+def ritardi_settimana(etichetta, date):
+    df = interroga_cubo(cubo_path, per=["route_id", "day_of_week", "hour"], date=date, quantili=())
+    return pd.DataFrame({
+        'route_id': "Linea " + df['route_id'].astype(str),
+        'hour': df['hour'].astype(str),
+        'delay': df['media_s'] / 60,
+        'week_range': etichetta,
+        'day_of_week': [GIORNI[g] for g in df['day_of_week']],
+    })
 
 # ========== Dataset base ==========
 
+# Dati di esempio, usati solo se il cubo dei ritardi non è ancora stato costruito
 data_fascia = pd.DataFrame({
     'route_id': [
         'Linea 73', 'Linea 664', 'Linea 107', 'Linea 107', 'Linea 64', 'Linea 063', 'Linea 058F', 'Linea 64',
@@ -79,9 +106,26 @@ st.title("Dashboard Ritardi Trasporti Pubblici - Roma")
 
 # Sidebar filtri
 st.sidebar.header("Filtri Ritardi Settimanali")
-week = st.sidebar.selectbox("Settimana:", sorted(data_fascia["week_range"].unique()))
-hours = st.sidebar.multiselect("Ore:", sorted(data_fascia['hour'].unique()), default=sorted(data_fascia['hour'].unique()))
-routes_sel = st.sidebar.multiselect("Linee:", sorted(data_fascia['route_id'].unique()), default=sorted(data_fascia['route_id'].unique()))
+settimane = settimane_cubo()
+if settimane:
+    week = st.sidebar.selectbox("Settimana:", list(settimane))
+    data_fascia = ritardi_settimana(week, settimane[week])
+    try:
+        corse_extra = carica_ottimizzazioni()[['route_id', 'hour', 'extra_trips']]
+        corse_extra = corse_extra.assign(route_id="Linea " + corse_extra['route_id'].astype(str))
+        corse_extra = corse_extra.groupby(['route_id', 'hour'], as_index=False)['extra_trips'].sum()
+        data_fascia = data_fascia.merge(corse_extra, on=['route_id', 'hour'], how='left')
+    except FileNotFoundError:
+        data_fascia['extra_trips'] = 0
+    data_fascia['extra_trips'] = data_fascia['extra_trips'].fillna(0)
+    # Di default le 20 linee con il ritardo medio più alto nella settimana
+    default_routes = data_fascia.groupby('route_id')['delay'].mean().nlargest(20).index.tolist()
+else:
+    st.caption("Cubo dei ritardi non trovato (python cubo_ritardi.py ritardi.parquet): vengono mostrati i dati di esempio.")
+    week = st.sidebar.selectbox("Settimana:", sorted(data_fascia["week_range"].unique()))
+    default_routes = sorted(data_fascia['route_id'].unique())
+hours = st.sidebar.multiselect("Ore:", sorted(data_fascia['hour'].unique(), key=int), default=sorted(data_fascia['hour'].unique(), key=int))
+routes_sel = st.sidebar.multiselect("Linee:", sorted(data_fascia['route_id'].unique()), default=sorted(default_routes))
 
 # Filtro
 filtered = data_fascia[(data_fascia['hour'].isin(hours)) & (data_fascia['route_id'].isin(routes_sel)) & (data_fascia['week_range'] == week)]
@@ -108,11 +152,7 @@ st.download_button("Scarica CSV", data=filtered.to_csv(index=False).encode('utf-
 # ========== Output modello prescrittivo ==========
 
 try:
-    file1, file2 = "ottimizzazione_dashboard_20250325_112654.csv", "ottimizzazione_dashboard_20250325_113839.csv"
-    df1, df2 = pd.read_csv(file1), pd.read_csv(file2)
-    df1["fascia_oraria"], df2["fascia_oraria"] = "13-14", "09-10"
-    df_opt = pd.concat([df1, df2], ignore_index=True)
-    df_opt['hour'] = df_opt['hour'].astype(str)
+    df_opt = carica_ottimizzazioni()
 
     st.sidebar.header("Filtri corse ottimizzate")
     fasce = st.sidebar.multiselect("Fascia oraria:", df_opt['fascia_oraria'].unique(), default=list(df_opt['fascia_oraria'].unique()))
@@ -134,33 +174,12 @@ except Exception as e:
 # ========== Mappa fermate ottimizzate ==========
 if st.checkbox("Visualizza mappa delle fermate ottimizzate"):
     try:
-        routes, trips, stops = carica_dataset_gtfs()
-        routes_filt = filtra_routes(routes, df_ottimizzato['route_id'].unique())
-        trips_filt = trips[trips['route_id'].isin(routes_filt['route_id'])]
-        stop_times = carica_stop_times("1Qx7jVKObRN79CLJwIy9Jzh0VwJ2D9dWZ")
-        stop_times_filt = stop_times[stop_times['trip_id'].isin(trips_filt['trip_id'].unique())]
-
-        fermate = genera_mappa_fermate(
-            trips_filt,
-            stop_times_filt,
-            stops,
-            df_ottimizzato[['route_id', 'hour']].drop_duplicates()
-        )
+        fermate = genera_mappa_fermate(carica_bundle_gtfs(), df_ottimizzato)
 
         if not fermate.empty:
-            fermate[['stop_lat', 'stop_lon']] = fermate[['stop_lat', 'stop_lon']].astype(float)
-            m = folium.Map(
-                location=[fermate['stop_lat'].mean(), fermate['stop_lon'].mean()],
-                zoom_start=12
-            )
-            for _, r in fermate.iterrows():
-                folium.CircleMarker(
-                    location=[r['stop_lat'], r['stop_lon']],
-                    radius=5, color=r['color'], fill=True,
-                    fill_color=r['color'], fill_opacity=0.8,
-                    tooltip=r['stop_name']
-                ).add_to(m)
-            st_folium(m, width=700, height=500)
+            # Un livello GeoJSON per linea al posto di un CircleMarker per riga
+            m = genera_mappa(fermate)
+            st_folium(m, width=700, height=500, returned_objects=[])
             st.dataframe(
                 fermate[['route_id', 'stop_name', 'stop_lat', 'stop_lon']]
                 .drop_duplicates().sort_values(by='route_id')
@@ -0,0 +1,191 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from gtfs_realtime_pb2 import FeedMessage
+from calcolo_ritardi import formatta_ritardo, inizio_giornata_servizio
+
+#Viaggi giornalieri per linea alla scala 1 (la scala 100 è dell'ordine del feed reale di Roma)
+VIAGGI_PER_LINEA = 3
+
+#Fermate per linea e velocità commerciale usate per gli orari programmati
+FERMATE_PER_LINEA = (15, 40)
+VELOCITA_M_S = 4.5
+SOSTA_S = 20
+
+#Linee e fermate reali distribuite con il repository, usate come base della rete sintetica
+cartella_repository = os.path.dirname(os.path.abspath(__file__))
+
+#Giornata di servizio simulata
+DATA_SERVIZIO = "2025-02-10"
+
+
+def _leggi_csv(percorso):
+    return pd.read_csv(percorso, dtype=str, encoding="utf-8-sig", keep_default_na=False)
+
+
+def _scrivi_csv(df, percorso):
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), percorso)
+
+
+#Percorso di una linea: fermate vicine a una fermata di partenza, ordinate lungo una direzione casuale
+def _percorso(lat, lon, rng):
+    n = rng.integers(*FERMATE_PER_LINEA, endpoint=True)
+    partenza = rng.integers(len(lat))
+    #Distanze approssimate in metri (sufficienti sulla scala di una città)
+    x = (lon - lon[partenza]) * 111_320 * np.cos(np.radians(lat[partenza]))
+    y = (lat - lat[partenza]) * 110_540
+    vicine = np.argpartition(x * x + y * y, n)[:n]
+    angolo = rng.uniform(0, np.pi)
+    ordine = vicine[np.argsort(x[vicine] * np.cos(angolo) + y[vicine] * np.sin(angolo))]
+    passi = np.hypot(np.diff(x[ordine]), np.diff(y[ordine]))
+    return ordine, np.concatenate([[0.0], np.cumsum(passi)])
+
+
+#GTFS statico sintetico a partire dalle linee e dalle fermate reali (routes.txt e stops.txt del repository)
+def genera_gtfs(cartella, scala=1, seed=0, routes_path=os.path.join(cartella_repository, "routes.txt"),
+                stops_path=os.path.join(cartella_repository, "stops.txt")):
+    rng = np.random.default_rng(seed)
+    os.makedirs(cartella, exist_ok=True)
+    routes = _leggi_csv(routes_path)
+    stops = _leggi_csv(stops_path)
+    lat, lon = stops["stop_lat"].astype(float).to_numpy(), stops["stop_lon"].astype(float).to_numpy()
+
+    trips, stop_times = [], []
+    for route_id in routes["route_id"]:
+        ordine, distanze = _percorso(lat, lon, rng)
+        #Andata e ritorno (stesse fermate in ordine inverso): fermate, distanze progressive e tempi di percorrenza
+        fermate = np.stack([ordine, ordine[::-1]])
+        progressive = np.stack([distanze, distanze[-1] - distanze[::-1]])
+        durate = (progressive / VELOCITA_M_S + SOSTA_S * np.arange(len(ordine))).astype(np.int64)
+
+        n_viaggi = VIAGGI_PER_LINEA * scala
+        partenze = np.sort(rng.integers(5 * 3600, 25 * 3600, n_viaggi))
+        direzioni = np.arange(n_viaggi) % 2
+        trip_ids = [f"{route_id}#{k}" for k in range(n_viaggi)]
+        trips.append(pd.DataFrame({
+            "route_id": route_id, "service_id": "FER", "trip_id": trip_ids,
+            "direction_id": direzioni, "shape_id": [f"{route_id}_{d}" for d in direzioni],
+        }))
+        stop_times.append(pd.DataFrame({
+            "trip_id": np.repeat(trip_ids, len(ordine)),
+            "arrival_time": (partenze[:, None] + durate[direzioni]).ravel(),
+            "stop_id": stops["stop_id"].to_numpy()[fermate[direzioni]].ravel(),
+            "stop_sequence": np.tile(np.arange(1, len(ordine) + 1), n_viaggi),
+            "shape_dist_traveled": np.round(progressive[direzioni], 1).ravel(),
+        }))
+
+    trips = pd.concat(trips, ignore_index=True)
+    stop_times = pd.concat(stop_times, ignore_index=True)
+    orari = formatta_ritardo(stop_times["arrival_time"])
+    testo = stop_times.assign(arrival_time=orari, departure_time=orari)[
+        ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence", "shape_dist_traveled"]
+    ]
+
+    _scrivi_csv(routes, os.path.join(cartella, "routes.txt"))
+    _scrivi_csv(stops, os.path.join(cartella, "stops.txt"))
+    _scrivi_csv(trips, os.path.join(cartella, "trips.txt"))
+    _scrivi_csv(testo, os.path.join(cartella, "stop_times.txt"))
+    return trips, stop_times
+
+
+#Ritardo sintetico con una componente per linea, una per ora di punta, una crescente lungo il viaggio e rumore
+def _ritardi(trips, stop_times, rng):
+    linee = pd.factorize(trips["route_id"])[0]
+    effetto_linea = rng.gamma(2.0, 90.0, linee.max() + 1)[linee]
+    viaggio = pd.Series(np.arange(len(trips)), index=trips["trip_id"]).reindex(stop_times["trip_id"]).to_numpy()
+    ora = (stop_times["arrival_time"].to_numpy() // 3600) % 24
+    punta = np.where(np.isin(ora, [7, 8, 9, 17, 18, 19]), 180, 0)
+    crescita = stop_times["stop_sequence"].to_numpy() * rng.uniform(3, 12, len(trips))[viaggio]
+    rumore = rng.normal(0, 60, len(stop_times))
+    return (effetto_linea[viaggio] + punta + crescita + rumore).astype(np.int64)
+
+
+#Snapshot GTFS-RT trip updates: ogni viaggio compare nell'ultimo snapshot precedente alla sua partenza
+def genera_trip_updates(cartella, trips, stop_times, n_snapshot=10, seed=0, data=DATA_SERVIZIO):
+    rng = np.random.default_rng(seed + 1)
+    os.makedirs(cartella, exist_ok=True)
+    inizio = int(inizio_giornata_servizio([data])[0])
+    arrivi = inizio + stop_times["arrival_time"].to_numpy() + _ritardi(trips, stop_times, rng)
+    partenze = stop_times.groupby("trip_id", sort=False)["arrival_time"].transform("min").to_numpy()
+    istanti = np.linspace(5 * 3600, 25 * 3600, n_snapshot, endpoint=False)
+    snapshot = np.clip(np.searchsorted(istanti, partenze, side="right") - 1, 0, n_snapshot - 1)
+    start_date = data.replace("-", "")
+
+    route_di = trips.set_index("trip_id")["route_id"].to_dict()
+    trip_ids = stop_times["trip_id"].to_numpy()
+    stop_ids = stop_times["stop_id"].to_numpy()
+    sequenze = stop_times["stop_sequence"].to_numpy().tolist()
+    arrivi = arrivi.tolist()
+    #Le righe di un viaggio sono contigue in stop_times: un'entità per ogni cambio di trip_id
+    inizi_viaggio = np.flatnonzero(np.r_[True, trip_ids[1:] != trip_ids[:-1]])
+    fini_viaggio = np.r_[inizi_viaggio[1:], len(trip_ids)]
+    for k in range(n_snapshot):
+        feed = FeedMessage()
+        feed.header.gtfs_realtime_version = "2.0"
+        feed.header.timestamp = inizio + int(istanti[k])
+        for a, b in zip(inizi_viaggio[snapshot[inizi_viaggio] == k], fini_viaggio[snapshot[inizi_viaggio] == k]):
+            entity = feed.entity.add()
+            entity.id = trip_ids[a]
+            entity.trip_update.trip.trip_id = trip_ids[a]
+            entity.trip_update.trip.route_id = route_di[trip_ids[a]]
+            entity.trip_update.trip.start_date = start_date
+            for i in range(a, b):
+                aggiornamento = entity.trip_update.stop_time_update.add()
+                aggiornamento.stop_id = stop_ids[i]
+                aggiornamento.stop_sequence = sequenze[i]
+                aggiornamento.arrival.time = arrivi[i]
+        with open(os.path.join(cartella, f"rome_trip_updates_{k:04d}.pb"), "wb") as f:
+            f.write(feed.SerializeToString())
+    return len(stop_times)
+
+
+#CSV meteo orario (formato di meteo.py --file-locale) per la giornata simulata e quelle vicine
+def genera_meteo(percorso, seed=0, data=DATA_SERVIZIO):
+    rng = np.random.default_rng(seed + 2)
+    ore = pd.date_range(pd.Timestamp(data) - pd.Timedelta(days=1), periods=72, freq="h", tz="UTC")
+    pioggia = np.where(rng.random(len(ore)) < 0.2, rng.exponential(2.0, len(ore)), 0.0)
+    pd.DataFrame({
+        "time": ore,
+        "temp": np.round(10 + 5 * np.sin((ore.hour - 9) / 24 * 2 * np.pi) + rng.normal(0, 1, len(ore)), 1),
+        "prcp": np.round(pioggia, 1),
+        "wspd": np.round(np.abs(rng.normal(9, 4, len(ore))), 1),
+    }).to_csv(percorso, index=False)
+
+
+#Dataset completo (GTFS statico, snapshot GTFS-RT e meteo) per una scala; riusato se già generato con gli stessi parametri
+def genera_dati(cartella, scala=1, seed=0, n_snapshot=10):
+    percorsi = {
+        "gtfs": os.path.join(cartella, "gtfs"),
+        "snapshot": os.path.join(cartella, "snapshot"),
+        "meteo": os.path.join(cartella, "meteo.csv"),
+    }
+    firma = os.path.join(cartella, "parametri.txt")
+    parametri = f"scala={scala} seed={seed} snapshot={n_snapshot} viaggi_per_linea={VIAGGI_PER_LINEA}"
+    if os.path.exists(firma) and open(firma).read() == parametri:
+        return percorsi
+
+    inizio = time.perf_counter()
+    trips, stop_times = genera_gtfs(percorsi["gtfs"], scala, seed)
+    genera_trip_updates(percorsi["snapshot"], trips, stop_times, n_snapshot, seed)
+    genera_meteo(percorsi["meteo"], seed)
+    with open(firma, "w") as f:
+        f.write(parametri)
+    print(f"Dati sintetici (scala {scala}): {len(trips)} viaggi, {len(stop_times)} orari "
+          f"in {time.perf_counter() - inizio:.2f} s")
+    return percorsi
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generazione di GTFS e GTFS-RT sintetici dalle linee e fermate reali")
+    parser.add_argument("cartella", help="cartella di output")
+    parser.add_argument("-s", "--scala", type=int, default=1, help=f"moltiplicatore dei viaggi ({VIAGGI_PER_LINEA} per linea alla scala 1)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--snapshot", type=int, default=10, help="numero di snapshot GTFS-RT")
+    args = parser.parse_args()
+
+    percorsi = genera_dati(args.cartella, args.scala, args.seed, args.snapshot)
+    print(f"GTFS in {percorsi['gtfs']}, snapshot in {percorsi['snapshot']}, meteo in {percorsi['meteo']}")
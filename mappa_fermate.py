@@ -0,0 +1,99 @@
+import folium
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+#Da 'Linea 64' (etichetta della dashboard) a '64' (route_id GTFS)
+def route_id_gtfs(etichette):
+    return pd.Series(etichette, dtype="string").str.replace("Linea ", "").str.strip()
+
+
+#Un viaggio rappresentativo per linea: la prima riga di ogni linea nell'indice a offset del bundle
+def viaggi_rappresentativi(bundle, route_ids):
+    richieste = pa.array(pd.unique(route_ids), pa.string())
+    posizioni = pc.index_in(richieste, value_set=bundle.indice_linee["route_id"])
+    trovate = pc.is_valid(posizioni)
+    inizi = pc.take(bundle.indice_linee["inizio"], posizioni.filter(trovate))
+    return pa.table({
+        "route_id": richieste.filter(trovate),
+        "trip_id": pc.take(bundle.trips["trip_id"], inizi),
+    })
+
+
+#Fermate di tutte le linee selezionate in un solo passaggio di join
+def fermate_delle_linee(bundle, etichette, palette=px.colors.qualitative.Set3):
+    linee = pd.DataFrame({"route_id": pd.unique(pd.Series(etichette, dtype="string"))})
+    linee["route_id_gtfs"] = route_id_gtfs(linee["route_id"]).to_numpy()
+    linee["color"] = [palette[i % len(palette)] for i in range(len(linee))]
+    linee["ordine"] = np.arange(len(linee))
+
+    rappresentativi = viaggi_rappresentativi(bundle, linee["route_id_gtfs"])
+    if rappresentativi.num_rows == 0:
+        return pd.DataFrame(columns=["route_id", "stop_id", "stop_name", "stop_lat", "stop_lon", "color", "linee"])
+
+    orari = bundle.fermate_dei_viaggi(rappresentativi["trip_id"].to_pylist()).select(["trip_id", "stop_id"])
+    fermate = (
+        orari.join(rappresentativi, keys="trip_id")
+        .join(bundle.stops.select(["stop_id", "stop_name", "stop_lat", "stop_lon"]), keys="stop_id")
+        .to_pandas()
+        .rename(columns={"route_id": "route_id_gtfs"})
+        .merge(linee, on="route_id_gtfs")
+        .drop_duplicates(subset=["route_id", "stop_id"])
+        .sort_values(["ordine", "stop_id"])
+    )
+
+    #Elenco delle linee che servono ciascuna fermata, per il tooltip delle fermate condivise
+    elenco = (
+        pa.Table.from_pandas(fermate[["stop_id", "route_id"]], preserve_index=False)
+        .cast(pa.schema([("stop_id", pa.string()), ("route_id", pa.string())]))
+        .group_by("stop_id", use_threads=False)
+        .aggregate([("route_id", "list")])
+    )
+    elenco = pa.table({"stop_id": elenco["stop_id"], "linee": pc.binary_join(elenco["route_id_list"], ", ")})
+    fermate = fermate.merge(elenco.to_pandas(), on="stop_id", how="left")
+    return fermate.drop(columns=["trip_id", "route_id_gtfs", "ordine"]).reset_index(drop=True)
+
+
+#Una FeatureCollection GeoJSON per linea; ogni fermata condivisa compare una sola volta (nella prima linea)
+def livelli_geojson(fermate):
+    uniche = fermate.drop_duplicates(subset="stop_id")
+    livelli = {}
+    for route_id, gruppo in uniche.groupby("route_id", sort=False):
+        livelli[route_id] = {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                    "properties": {"stop_name": nome, "linee": linee, "color": colore},
+                }
+                for lon, lat, nome, linee, colore in zip(
+                    gruppo["stop_lon"].to_numpy(), gruppo["stop_lat"].to_numpy(),
+                    gruppo["stop_name"].to_numpy(), gruppo["linee"].to_numpy(), gruppo["color"].to_numpy(),
+                )
+            ],
+        }
+    return livelli
+
+
+def _stile(feature):
+    colore = feature["properties"]["color"]
+    return {"color": colore, "fillColor": colore, "fillOpacity": 0.8, "radius": 5}
+
+
+#Mappa folium con un livello GeoJSON attivabile per ogni linea
+def genera_mappa(fermate, zoom_start=12):
+    m = folium.Map(location=[fermate["stop_lat"].mean(), fermate["stop_lon"].mean()], zoom_start=zoom_start)
+    for route_id, collezione in livelli_geojson(fermate).items():
+        folium.GeoJson(
+            collezione,
+            name=route_id,
+            marker=folium.CircleMarker(radius=5, fill=True),
+            style_function=_stile,
+            tooltip=folium.GeoJsonTooltip(fields=["stop_name", "linee"], aliases=["Fermata", "Linee"]),
+        ).add_to(m)
+    folium.LayerControl(collapsed=True).add_to(m)
+    return m
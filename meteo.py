@@ -0,0 +1,157 @@
+import argparse
+import os
+import pandas as pd
+from comune import italian_timezone, scrivi_parquet
+
+# Archivio locale dei dati meteo orari di Roma
+meteo_path = "meteo_cache/roma_orario.parquet"
+
+#Coordinate di Roma usate dai notebook
+LATITUDINE, LONGITUDINE = 41.9028, 12.4964
+
+COLONNE_METEO = ["tavg", "prcp", "wspd"]
+
+#I dati delle ultime ore/giorni sono provvisori: vengono riscaricati dopo il TTL se erano recenti al momento del download
+TTL = pd.Timedelta(hours=6)
+FINESTRA_PROVVISORIA = pd.Timedelta(days=7)
+
+
+def _ora(ts):
+    ts = pd.Timestamp(ts)
+    ts = ts.tz_localize(italian_timezone) if ts.tz is None else ts
+    return ts.tz_convert("UTC").floor("h")
+
+
+#Download orario da meteostat (libreria opzionale); 'time' in UTC
+def _scarica_meteostat(inizio, fine):
+    from meteostat import Hourly, Point
+    dati = Hourly(Point(LATITUDINE, LONGITUDINE), inizio.tz_localize(None).to_pydatetime(),
+                  fine.tz_localize(None).to_pydatetime()).fetch()
+    dati = dati.reset_index().rename(columns={"temp": "tavg"})
+    dati["time"] = pd.to_datetime(dati["time"]).dt.tz_localize("UTC")
+    return dati[["time"] + COLONNE_METEO]
+
+
+#Sostituto locale per le esecuzioni offline: CSV con colonne time,tavg(o temp),prcp,wspd
+def _leggi_file_locale(percorso, inizio, fine):
+    dati = pd.read_csv(percorso).rename(columns={"temp": "tavg"})
+    tempo = pd.to_datetime(dati["time"])
+    dati["time"] = tempo.dt.tz_localize("UTC") if tempo.dt.tz is None else tempo.dt.tz_convert("UTC")
+    return dati.loc[dati["time"].between(inizio, fine), ["time"] + COLONNE_METEO]
+
+
+def leggi_archivio_meteo(percorso=meteo_path):
+    if not os.path.exists(percorso):
+        return pd.DataFrame({
+            "time": pd.Series(dtype="datetime64[ns, UTC]"),
+            **{c: pd.Series(dtype="float64") for c in COLONNE_METEO},
+            "aggiornato_il": pd.Series(dtype="datetime64[ns, UTC]"),
+        })
+    return pd.read_parquet(percorso)
+
+
+#Ore del periodo richiesto mancanti nell'archivio, oppure provvisorie o senza osservazioni e scadute
+def _ore_da_scaricare(archivio, inizio, fine, adesso, ttl):
+    ore = pd.date_range(inizio, fine, freq="h")
+    archivio = archivio.set_index("time")
+    presenti = archivio["aggiornato_il"].reindex(ore)
+    mancanti = presenti.isna()
+    provvisorie = (presenti - presenti.index) < FINESTRA_PROVVISORIA
+    vuote = archivio[COLONNE_METEO].isna().all(axis=1).reindex(ore, fill_value=False)
+    scadute = (adesso - presenti) > ttl
+    return ore[(mancanti | ((provvisorie | vuote) & scadute)).to_numpy()]
+
+
+#Dati meteo orari del periodo richiesto, scaricati solo se assenti o scaduti nell'archivio locale
+def meteo_orario(inizio, fine, percorso=meteo_path, file_locale=None, ttl=TTL, offline=False):
+    inizio, fine = _ora(inizio), _ora(fine)
+    archivio = leggi_archivio_meteo(percorso)
+    adesso = pd.Timestamp.now(tz="UTC")
+    da_scaricare = _ore_da_scaricare(archivio, inizio, fine, adesso, ttl)
+
+    if len(da_scaricare):
+        if file_locale is not None:
+            nuovi = _leggi_file_locale(file_locale, da_scaricare.min(), da_scaricare.max())
+        elif offline:
+            nuovi = None
+        else:
+            nuovi = _scarica_meteostat(da_scaricare.min(), da_scaricare.max())
+        #Una risposta senza alcuna osservazione (meteostat la restituisce anche per errori di rete) non viene
+        #registrata, così le stesse ore sono richieste di nuovo alla prossima esecuzione
+        if nuovi is not None and nuovi[COLONNE_METEO].notna().any(axis=1).any():
+            #Le ore senza osservazioni di una risposta valida sono registrate e riprovate dopo il TTL
+            periodo = pd.date_range(da_scaricare.min(), da_scaricare.max(), freq="h", name="time")
+            nuovi = nuovi.drop_duplicates("time").set_index("time").reindex(periodo).reset_index()
+            nuovi = nuovi.assign(aggiornato_il=adesso)
+            #e non sostituiscono osservazioni già archiviate
+            osservate = archivio.loc[archivio[COLONNE_METEO].notna().any(axis=1), "time"]
+            nuovi = nuovi[nuovi[COLONNE_METEO].notna().any(axis=1) | ~nuovi["time"].isin(osservate)]
+            archivio = pd.concat([archivio[~archivio["time"].isin(nuovi["time"])], nuovi], ignore_index=True)
+            #Archivio e nuove ore possono avere risoluzioni o fusi UTC diversi (altrimenti la colonna diventa object)
+            archivio = archivio.assign(time=pd.to_datetime(archivio["time"], utc=True),
+                                       aggiornato_il=pd.to_datetime(archivio["aggiornato_il"], utc=True))
+            archivio = archivio.sort_values("time").reset_index(drop=True)
+            os.makedirs(os.path.dirname(percorso) or ".", exist_ok=True)
+            scrivi_parquet(archivio, percorso)
+
+    return archivio[archivio["time"].between(inizio, fine)].reset_index(drop=True)
+
+
+#Aggregazione giornaliera (data locale), equivalente ai vecchi dati meteostat Daily
+def meteo_giornaliero(orario):
+    giorno = orario["time"].dt.tz_convert(italian_timezone).dt.normalize().dt.tz_localize(None)
+    return orario.groupby(giorno.rename("arrival_date")).agg(
+        tavg=("tavg", "mean"), prcp=("prcp", "sum"), wspd=("wspd", "mean")
+    ).reset_index()
+
+
+#Istante (UTC) di ciascun evento di ritardo
+def timestamp_evento(df):
+    if "arrival_time_utc" in df.columns:
+        return pd.to_datetime(df["arrival_time_utc"], utc=True)
+    #arrival_time_x può essere testo HH:MM:SS oppure già convertito in datetime (come nel notebook prescrittivo)
+    ora = df["arrival_time_x"]
+    if pd.api.types.is_datetime64_any_dtype(ora):
+        ora = ora - ora.dt.normalize()
+    else:
+        ora = pd.to_timedelta(ora.astype(str), errors="coerce")
+    locale = pd.to_datetime(df["arrival_date"], errors="coerce").dt.normalize() + ora
+    return locale.dt.tz_localize(italian_timezone, ambiguous="NaT", nonexistent="NaT").dt.tz_convert("UTC")
+
+
+#Join as-of vettoriale: ad ogni evento il dato meteo dell'ultima ora disponibile (entro la tolleranza)
+def aggiungi_meteo(df, percorso=meteo_path, file_locale=None, offline=False, tolleranza=pd.Timedelta(hours=2)):
+    df = df.drop(columns=[c for c in COLONNE_METEO if c in df.columns])
+    istanti = timestamp_evento(df)
+    validi = istanti.notna()
+    if not validi.any():
+        return df.assign(**{c: float("nan") for c in COLONNE_METEO})
+
+    meteo = meteo_orario(istanti[validi].min(), istanti[validi].max(), percorso, file_locale, offline=offline)
+    eventi = pd.DataFrame({"time": istanti[validi].astype("datetime64[ns, UTC]"),
+                           "riga": validi[validi].index}).sort_values("time")
+    unito = pd.merge_asof(eventi, meteo[["time"] + COLONNE_METEO].astype({"time": "datetime64[ns, UTC]"}),
+                          on="time", direction="backward", tolerance=tolleranza)
+    unito = unito.set_index("riga").reindex(df.index)
+    return df.assign(**{c: unito[c].to_numpy() for c in COLONNE_METEO})
+
+
+#Valori mancanti come nei notebook: media per temperatura e vento, 0 per la pioggia
+def riempi_mancanti(df):
+    return df.assign(
+        tavg=df["tavg"].fillna(df["tavg"].mean()),
+        prcp=df["prcp"].fillna(0),
+        wspd=df["wspd"].fillna(df["wspd"].mean()),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggiornamento dell'archivio locale dei dati meteo di Roma")
+    parser.add_argument("inizio", help="data/ora iniziale (ora locale), es. 2025-02-10")
+    parser.add_argument("fine", help="data/ora finale (ora locale), es. 2025-02-14T23:00")
+    parser.add_argument("-a", "--archivio", default=meteo_path, help="file Parquet dell'archivio meteo")
+    parser.add_argument("--file-locale", default=None, help="CSV orario da usare al posto di meteostat (offline)")
+    args = parser.parse_args()
+
+    dati = meteo_orario(args.inizio, args.fine, args.archivio, args.file_locale)
+    print(f"{len(dati)} ore di dati meteo disponibili in {args.archivio}")
@@ -0,0 +1,209 @@
+import argparse
+import os
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_absolute_error
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import TargetEncoder
+from comune import italian_timezone
+from meteo import COLONNE_METEO, aggiungi_meteo, meteo_path, riempi_mancanti, timestamp_evento
+
+# File di default del modello addestrato (encoder inclusi)
+modello_path = "modello_ritardi.joblib"
+
+#Stesse variabili del vecchio modello LSTM
+FEATURES = ["route_id", "stop_id", "day_of_week", "hour", "shape_dist_traveled", "tavg", "prcp", "wspd"]
+CATEGORICHE = ["route_id", "stop_id"]
+TARGET = "delay_minutes"
+
+#Ritardi considerati nell'addestramento (minuti), come nel notebook
+INTERVALLO_MINUTI = (-15, 120)
+
+
+#Ritardi consistenti in Parquet (calcolo_ritardi.py) oppure nel vecchio formato testo
+def carica_ritardi(percorso):
+    if percorso.endswith((".txt", ".csv")):
+        return pd.read_csv(percorso, sep=",", dtype={"route_id": str, "stop_id": str})
+    return pd.read_parquet(percorso)
+
+
+#Ritardi con il meteo orario dell'evento (dall'archivio locale se non già presente) e i valori mancanti riempiti
+def carica_ritardi_con_meteo(percorso, percorso_meteo=meteo_path, file_meteo=None, offline=False):
+    df = carica_ritardi(percorso)
+    if not set(COLONNE_METEO) <= set(df.columns):
+        df = aggiungi_meteo(df, percorso_meteo, file_meteo, offline)
+    return riempi_mancanti(df)
+
+
+def minuti_di_ritardo(df):
+    if "delay_s" in df.columns:
+        return df["delay_s"].astype("float64") / 60
+    return pd.to_timedelta(df["delay"], errors="coerce").dt.total_seconds() / 60
+
+
+#Matrice delle feature di un insieme di eventi; le colonne mancanti restano NaN (gestiti nativamente dagli alberi)
+def prepara_feature(events):
+    X = pd.DataFrame(index=events.index)
+    for colonna in CATEGORICHE:
+        X[colonna] = events[colonna].astype(str).astype(object)
+    if "day_of_week" in events.columns and "hour" in events.columns:
+        X["day_of_week"] = events["day_of_week"]
+        X["hour"] = events["hour"]
+    else:
+        locale = timestamp_evento(events).dt.tz_convert(italian_timezone)
+        X["day_of_week"] = locale.dt.dayofweek
+        X["hour"] = locale.dt.hour
+    for colonna in ["shape_dist_traveled"] + COLONNE_METEO:
+        X[colonna] = pd.to_numeric(events[colonna], errors="coerce") if colonna in events.columns else np.nan
+    return X[FEATURES].astype({c: "float64" for c in FEATURES if c not in CATEGORICHE})
+
+
+#Feature e target per l'addestramento, con il filtro sui ritardi del notebook
+def prepara_dati(df, intervallo=INTERVALLO_MINUTI):
+    y = minuti_di_ritardo(df)
+    df, y = df[y.between(*intervallo)], y[y.between(*intervallo)]
+    return prepara_feature(df), y.rename(TARGET)
+
+
+#Gradient boosting su feature tabellari: route_id e stop_id con target encoding (cross-fitting in addestramento)
+class PredittoreRitardi:
+    def __init__(self, max_iter=300, learning_rate=0.1, random_state=42):
+        codifica = ColumnTransformer(
+            [("categoriche", TargetEncoder(target_type="continuous"), CATEGORICHE)],
+            remainder="passthrough",
+            verbose_feature_names_out=False,
+        )
+        self.modello = Pipeline([
+            ("codifica", codifica),
+            ("alberi", HistGradientBoostingRegressor(max_iter=max_iter, learning_rate=learning_rate,
+                                                     early_stopping=True, random_state=random_state)),
+        ])
+        self.riempimenti = {}
+
+    def addestra(self, X, y):
+        #Valori del meteo mancante come in riempi_mancanti (media, 0 per la pioggia), salvati con il modello per
+        #riempire allo stesso modo gli eventi da prevedere; le colonne interamente vuote valgono 0
+        self.riempimenti = {c: 0.0 if c == "prcp" else X[c].mean() for c in COLONNE_METEO}
+        self.riempimenti = {c: 0.0 if pd.isna(v) else float(v) for c, v in self.riempimenti.items()}
+        X = X.fillna(self.riempimenti)
+        X = X.fillna({c: 0.0 for c in X.columns[X.isna().all()]})
+        self.modello.fit(X, y)
+        return self
+
+    #Ritardo previsto (minuti) per tutti gli eventi in un'unica chiamata vettoriale. Agli eventi senza meteo si
+    #unisce quello dell'archivio locale; ciò che resta mancante prende i valori usati in addestramento
+    def predict_batch(self, events, percorso_meteo=meteo_path, file_meteo=None, offline=False):
+        if not set(COLONNE_METEO) <= set(events.columns):
+            events = aggiungi_meteo(events, percorso_meteo, file_meteo, offline)
+        return self.modello.predict(prepara_feature(events).fillna(self.riempimenti))
+
+    #Andamento della loss (MSE) su addestramento e validazione interna, per iterazione
+    def curva_loss(self):
+        alberi = self.modello.named_steps["alberi"]
+        return pd.DataFrame({"loss": -alberi.train_score_, "val_loss": -alberi.validation_score_})
+
+    def salva(self, percorso=modello_path):
+        joblib.dump({"modello": self.modello, "riempimenti": self.riempimenti}, percorso)
+
+    @classmethod
+    def carica(cls, percorso=modello_path):
+        predittore = cls.__new__(cls)
+        salvato = joblib.load(percorso)
+        predittore.modello = salvato["modello"]
+        predittore.riempimenti = salvato["riempimenti"]
+        return predittore
+
+
+#Addestramento su tutti i ritardi disponibili e salvataggio del modello con i suoi encoder
+def addestra_modello(df, output=modello_path):
+    X, y = prepara_dati(df)
+    PredittoreRitardi().addestra(X, y).salva(output)
+    return {"eventi": len(X)}
+
+
+#Il vecchio modello del notebook: ID codificati e standardizzati, 8 feature come sequenza di lunghezza 8
+def _lstm(X_train, y_train, X_test, epochs, batch_size):
+    from sklearn.preprocessing import LabelEncoder, StandardScaler
+    from tensorflow.keras.layers import LSTM, Dense, Dropout
+    from tensorflow.keras.models import Sequential
+
+    X_train, X_test = X_train.copy(), X_test.copy()
+    for colonna in CATEGORICHE:
+        encoder = LabelEncoder().fit(pd.concat([X_train[colonna], X_test[colonna]]))
+        X_train[colonna], X_test[colonna] = encoder.transform(X_train[colonna]), encoder.transform(X_test[colonna])
+    scaler = StandardScaler().fit(X_train.fillna(0))
+    X_train = scaler.transform(X_train.fillna(0))[..., None]
+    X_test = scaler.transform(X_test.fillna(0))[..., None]
+
+    model = Sequential([
+        LSTM(50, return_sequences=True, input_shape=(X_train.shape[1], 1)),
+        Dropout(0.2),
+        LSTM(50, return_sequences=False),
+        Dropout(0.2),
+        Dense(25, activation="relu"),
+        Dense(1),
+    ])
+    model.compile(optimizer="adam", loss="mse", metrics=["mae"])
+    inizio = time.perf_counter()
+    model.fit(X_train, y_train, epochs=epochs, batch_size=batch_size, verbose=0)
+    addestramento = time.perf_counter() - inizio
+    inizio = time.perf_counter()
+    previsti = model.predict(X_test, batch_size=4096, verbose=0).ravel()
+    return addestramento, time.perf_counter() - inizio, previsti
+
+
+#Confronto tra il predittore tabellare e l'LSTM del notebook: tempi di addestramento, latenza di inferenza e MAE
+def benchmark(df, lstm=True, epochs=50, batch_size=32, test_size=0.2, random_state=42):
+    X, y = prepara_dati(df)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=random_state)
+    risultati = []
+
+    inizio = time.perf_counter()
+    predittore = PredittoreRitardi(random_state=random_state).addestra(X_train, y_train)
+    addestramento = time.perf_counter() - inizio
+    inizio = time.perf_counter()
+    previsti = predittore.predict_batch(X_test)
+    inferenza = time.perf_counter() - inizio
+    risultati.append({"modello": "gradient boosting", "secondi_import": 0.0, "secondi_addestramento": addestramento,
+                      "secondi_inferenza": inferenza, "mae_minuti": mean_absolute_error(y_test, previsti)})
+
+    if lstm:
+        inizio = time.perf_counter()
+        try:
+            import tensorflow  # noqa: F401
+        except ImportError:
+            print("tensorflow non installato: confronto con l'LSTM saltato")
+        else:
+            importazione = time.perf_counter() - inizio
+            addestramento, inferenza, previsti = _lstm(X_train, y_train, X_test, epochs, batch_size)
+            risultati.append({"modello": "LSTM", "secondi_import": importazione, "secondi_addestramento": addestramento,
+                              "secondi_inferenza": inferenza, "mae_minuti": mean_absolute_error(y_test, previsti)})
+
+    risultati = pd.DataFrame(risultati)
+    risultati["eventi_test"] = len(X_test)
+    risultati["microsecondi_per_evento"] = risultati["secondi_inferenza"] / len(X_test) * 1e6
+    return risultati
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Addestramento del predittore dei ritardi")
+    parser.add_argument("ritardi", help="ritardi consistenti (Parquet di calcolo_ritardi.py oppure ritardi_consistenti.txt)")
+    parser.add_argument("-o", "--output", default=modello_path, help="file del modello addestrato")
+    parser.add_argument("--file-meteo", default=None, help="CSV meteo orario da usare al posto di meteostat (offline)")
+    parser.add_argument("--benchmark", action="store_true", help="confronta tempi e MAE con l'LSTM del notebook")
+    parser.add_argument("--epochs", type=int, default=50, help="epoche dell'LSTM nel benchmark")
+    args = parser.parse_args()
+
+    df = carica_ritardi_con_meteo(args.ritardi, file_meteo=args.file_meteo)
+
+    if args.benchmark:
+        print(benchmark(df, epochs=args.epochs).to_string(index=False))
+    else:
+        inizio = time.perf_counter()
+        stats = addestra_modello(df, args.output)
+        print(f"Modello addestrato su {stats['eventi']} eventi in {time.perf_counter() - inizio:.2f} s e salvato in: {os.path.abspath(args.output)}")
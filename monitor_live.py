@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import os
+import time
+from collections import deque
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import requests
+from archivio_trip_updates import calcola_service_date
+from bundle_gtfs import BundleGTFS
+from calcolo_ritardi import SOGLIA_RITARDO, ritardo_secondi, secondi_giornata_servizio
+from comune import scrivi_parquet
+from rome_trip_updates import converti_orari, elenca_snapshot, estrai_colonne_da_bytes
+
+# Cartella di default dello stato condiviso letto dalla dashboard
+monitor_path = "stato_monitor"
+
+#Secondi tra due interrogazioni della sorgente
+INTERVALLO = 30
+
+#Finestra delle statistiche mobili per linea
+FINESTRA = pd.Timedelta(minutes=15)
+
+#Ritardi considerati plausibili (secondi), come nel cubo
+INTERVALLO_RITARDI = (-3600, 7200)
+
+#Snapshot conservati nello storico mostrato dalla dashboard
+MAX_STORICO = 240
+
+_SEPARATORE = "\x1f"
+
+
+def _chiavi(trip_id, secondo):
+    return pd.Index(pc.binary_join_element_wise(trip_id, secondo, _SEPARATORE).to_numpy(zero_copy_only=False))
+
+
+#Orario programmato in memoria: per ogni (trip_id, stop_sequence) l'arrivo in secondi e la linea, con una tabella
+#hash costruita una sola volta e interrogata ad ogni snapshot
+class IndiceOrari:
+
+    def __init__(self, trip_id, stop_id, stop_sequence, route_id, arrival_time):
+        #La sequenza distingue i passaggi ripetuti alla stessa fermata (percorsi circolari)
+        self.chiavi = _chiavi(trip_id, pc.cast(stop_sequence, pa.string()))
+        self.arrivi = np.asarray(arrival_time, dtype=np.int32)
+        self.sequenze = np.asarray(stop_sequence, dtype=np.int32)
+        self.linee = pd.Categorical(np.asarray(route_id, dtype=object))
+        #Per le previsioni senza stop_sequence resta la ricerca per fermata, sul primo passaggio
+        chiavi_fermata = _chiavi(trip_id, stop_id)
+        prime = ~chiavi_fermata.duplicated()
+        self.chiavi_fermata = chiavi_fermata[prime]
+        self.posizioni_fermata = np.flatnonzero(prime)
+        #Le tabelle hash vengono costruite alla prima ricerca: le si prepara subito, non sul primo snapshot
+        self.chiavi.get_indexer(self.chiavi[:1])
+        self.chiavi_fermata.get_indexer(self.chiavi_fermata[:1])
+
+    #Dal bundle di bundle_gtfs.py (la linea di ogni viaggio viene dalla tabella trips)
+    @classmethod
+    def da_bundle(cls, bundle):
+        orari = bundle.trip_stops.select(["trip_id", "stop_id", "stop_sequence", "arrival_time"]).join(
+            bundle.trips.select(["trip_id", "route_id"]), keys="trip_id"
+        )
+        return cls(orari["trip_id"], orari["stop_id"], orari["stop_sequence"], orari["route_id"], orari["arrival_time"])
+
+    #Dal Parquet di preprocessing_gtfs.py
+    @classmethod
+    def da_parquet(cls, percorso):
+        orari = pq.read_table(percorso, columns=["trip_id", "stop_id", "stop_sequence", "route_id", "arrival_time"])
+        orari = orari.cast(pa.schema([("trip_id", pa.string()), ("stop_id", pa.string()), ("stop_sequence", pa.int32()),
+                                      ("route_id", pa.string()), ("arrival_time", pa.int32())]))
+        return cls(orari["trip_id"], orari["stop_id"], orari["stop_sequence"], orari["route_id"], orari["arrival_time"])
+
+    @classmethod
+    def carica(cls, percorso):
+        return cls.da_bundle(BundleGTFS(percorso)) if os.path.isdir(percorso) else cls.da_parquet(percorso)
+
+    def __len__(self):
+        return len(self.chiavi)
+
+    #Ritardo in secondi delle previsioni di uno snapshot che trovano corrispondenza nell'orario, con la
+    #stop_sequence dell'orario (anche per le previsioni abbinate per fermata)
+    def ritardi(self, trip_updates):
+        trip_id = pa.array(trip_updates["trip_id"], pa.string())
+        sequenza = pa.array(trip_updates["stop_sequence"], pa.int32())
+        posizioni = self.chiavi.get_indexer(_chiavi(trip_id, pc.cast(sequenza, pa.string())))
+        #stop_sequence 0 significa campo assente nel feed
+        senza_sequenza = np.flatnonzero(sequenza.to_numpy(zero_copy_only=False) <= 0)
+        if len(senza_sequenza):
+            fermate = pa.array(trip_updates["stop_id"].to_numpy()[senza_sequenza], pa.string())
+            trovate = self.chiavi_fermata.get_indexer(_chiavi(trip_id.take(senza_sequenza), fermate))
+            posizioni[senza_sequenza] = np.where(trovate >= 0, self.posizioni_fermata[trovate], -1)
+        trovate = posizioni >= 0
+        abbinati = trip_updates[trovate]
+        posizioni = posizioni[trovate]
+        arrivo = secondi_giornata_servizio(abbinati["arrival_time_utc"], calcola_service_date(abbinati))
+        return pd.DataFrame({
+            "route_id": self.linee.take(posizioni) if len(posizioni) else pd.Categorical([]),
+            "trip_id": abbinati["trip_id"].to_numpy(),
+            "stop_sequence": self.sequenze[posizioni],
+            "delay_s": ritardo_secondi(arrivo, self.arrivi[posizioni]),
+        })
+
+
+#Ritardi plausibili di uno snapshot: lo stesso filtro vale per le statistiche per linea e per la media di rete
+def ritardi_plausibili(ritardi):
+    return ritardi[ritardi["delay_s"].between(*INTERVALLO_RITARDI)]
+
+
+#Statistiche mobili per linea: ogni passaggio (trip_id, stop_sequence) conta una volta sola con l'ultimo ritardo
+#previsto nella finestra, anche se compare in tutti gli snapshot
+class StatisticheLinee:
+
+    CHIAVE = ["trip_id", "stop_sequence"]
+
+    def __init__(self, finestra=FINESTRA):
+        self.finestra = finestra
+        self.snapshot = deque()
+        self.ultimi = pd.DataFrame({
+            "route_id": pd.Series(dtype=str), "trip_id": pd.Series(dtype=str),
+            "stop_sequence": pd.Series(dtype=np.int32), "delay_s": pd.Series(dtype=np.int32),
+            "snapshot_ts": pd.Series(dtype="datetime64[ns, UTC]"),
+        })
+
+    def aggiungi(self, snapshot_ts, ritardi):
+        self.snapshot.append(snapshot_ts)
+        while self.snapshot[0] < snapshot_ts - self.finestra:
+            self.snapshot.popleft()
+        nuovi = ritardi[["route_id", "trip_id", "stop_sequence", "delay_s"]].astype({"route_id": str})
+        ultimi = pd.concat([self.ultimi, nuovi.assign(snapshot_ts=snapshot_ts)], ignore_index=True)
+        ultimi = ultimi.drop_duplicates(self.CHIAVE, keep="last")
+        self.ultimi = ultimi[ultimi["snapshot_ts"] >= self.snapshot[0]].reset_index(drop=True)
+
+    #Statistiche della finestra corrente; 'viaggi' è quello dell'ultimo snapshot
+    def tabella(self):
+        colonne = ["route_id", "n", "media_s", "max_s", "quota_oltre_soglia", "viaggi", "snapshot"]
+        if self.ultimi.empty:
+            return pd.DataFrame(columns=colonne)
+        delay = self.ultimi["delay_s"].astype(np.float64)
+        linee = self.ultimi["route_id"]
+        totale = pd.DataFrame({
+            "n": delay.groupby(linee).size(),
+            "media_s": delay.groupby(linee).mean(),
+            "max_s": delay.groupby(linee).max(),
+            "quota_oltre_soglia": (delay > SOGLIA_RITARDO).groupby(linee).mean(),
+        })
+        recenti = self.ultimi[self.ultimi["snapshot_ts"] == self.snapshot[-1]]
+        totale["viaggi"] = recenti["trip_id"].groupby(recenti["route_id"]).nunique().reindex(totale.index).fillna(0).astype(int)
+        totale["snapshot"] = len(self.snapshot)
+        return totale.rename_axis("route_id").reset_index()[colonne]
+
+
+def scrivi_stato(cartella, linee, storico):
+    os.makedirs(cartella, exist_ok=True)
+    scrivi_parquet(linee, os.path.join(cartella, "linee.parquet"))
+    scrivi_parquet(storico, os.path.join(cartella, "storico.parquet"))
+
+
+#Stato corrente per la dashboard: statistiche per linea e storico degli snapshot (None se il monitor non è attivo)
+def leggi_stato(cartella=monitor_path):
+    linee, storico = os.path.join(cartella, "linee.parquet"), os.path.join(cartella, "storico.parquet")
+    if not (os.path.exists(linee) and os.path.exists(storico)):
+        return None, None
+    return pd.read_parquet(linee), pd.read_parquet(storico)
+
+
+class Monitor:
+
+    def __init__(self, indice, cartella=monitor_path, finestra=FINESTRA):
+        self.indice = indice
+        self.cartella = cartella
+        self.statistiche = StatisticheLinee(finestra)
+        self.storico = deque(maxlen=MAX_STORICO)
+        self.ultimo_snapshot = None
+        self.scartati = 0
+
+    #Decodifica, ritardi, aggiornamento delle statistiche e scrittura dello stato (eseguita fuori dall'event loop)
+    def elabora(self, dati, ricevuto):
+        inizio = time.perf_counter()
+        trip_updates = pd.DataFrame(estrai_colonne_da_bytes(dati))
+        if trip_updates.empty:
+            return None
+        snapshot_ts = pd.Timestamp(int(trip_updates["snapshot_ts"].iloc[0]), unit="s", tz="UTC")
+        #Il feed non è ancora stato aggiornato dalla sorgente
+        if snapshot_ts == self.ultimo_snapshot:
+            return None
+        self.ultimo_snapshot = snapshot_ts
+
+        trip_updates = converti_orari(trip_updates)
+        ritardi = self.indice.ritardi(trip_updates)
+        plausibili = ritardi_plausibili(ritardi)
+        self.statistiche.aggiungi(snapshot_ts, plausibili)
+        linee = self.statistiche.tabella()
+        riga = {
+            "snapshot_ts": snapshot_ts,
+            "eventi": len(trip_updates),
+            "abbinati": len(ritardi),
+            "media_s": float(plausibili["delay_s"].mean()) if len(plausibili) else np.nan,
+            "secondi_elaborazione": time.perf_counter() - inizio,
+            #Dalla ricezione dello snapshot (compresa l'attesa in coda) alle statistiche pronte per la pubblicazione
+            "latenza_s": time.time() - ricevuto,
+            "scartati": self.scartati,
+        }
+        self.storico.append(riga)
+        scrivi_stato(self.cartella, linee, pd.DataFrame(list(self.storico)))
+        return riga
+
+
+#Coda con un solo posto: se l'elaborazione è in ritardo lo snapshot in attesa viene sostituito dal più recente
+def _metti(coda, elemento, monitor):
+    if coda.full():
+        coda.get_nowait()
+        monitor.scartati += 1
+    coda.put_nowait(elemento)
+
+
+async def _interroga_url(url, intervallo, coda, monitor):
+    sessione = requests.Session()
+    while True:
+        try:
+            risposta = await asyncio.to_thread(sessione.get, url, timeout=intervallo)
+            risposta.raise_for_status()
+            _metti(coda, (risposta.content, time.time()), monitor)
+        except requests.RequestException as e:
+            print(f"Errore durante lo scarico del feed: {e}")
+        await asyncio.sleep(intervallo)
+
+
+#Sostituto locale del feed: i nuovi file .pb depositati nella cartella, in ordine di nome
+async def _interroga_cartella(cartella, intervallo, coda, monitor):
+    visti = set()
+    while True:
+        for percorso in elenca_snapshot(cartella):
+            if percorso not in visti:
+                visti.add(percorso)
+                with open(percorso, "rb") as f:
+                    _metti(coda, (f.read(), time.time()), monitor)
+                await asyncio.sleep(0)
+        await asyncio.sleep(intervallo)
+
+
+async def _consuma(coda, monitor, max_snapshot):
+    elaborati = 0
+    while max_snapshot is None or elaborati < max_snapshot:
+        dati, ricevuto = await coda.get()
+        riga = await asyncio.to_thread(monitor.elabora, dati, ricevuto)
+        if riga is not None:
+            elaborati += 1
+            print(f"{riga['snapshot_ts']:%H:%M:%S} {riga['eventi']} previsioni, {riga['abbinati']} abbinate, "
+                  f"ritardo medio {riga['media_s'] / 60:.1f} min, latenza {riga['latenza_s']:.2f} s")
+
+
+#Servizio di monitoraggio: interroga la sorgente (URL GTFS-RT o cartella) e pubblica le statistiche per linea
+async def monitora(sorgente, indice, cartella=monitor_path, intervallo=INTERVALLO, finestra=FINESTRA, max_snapshot=None):
+    monitor = Monitor(indice, cartella, finestra)
+    coda = asyncio.Queue(maxsize=1)
+    if sorgente.startswith(("http://", "https://")):
+        produttore = asyncio.create_task(_interroga_url(sorgente, intervallo, coda, monitor))
+    else:
+        produttore = asyncio.create_task(_interroga_cartella(sorgente, intervallo, coda, monitor))
+    try:
+        await _consuma(coda, monitor, max_snapshot)
+    finally:
+        produttore.cancel()
+    return monitor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monitoraggio in tempo reale dei ritardi dal feed GTFS-RT")
+    parser.add_argument("sorgente", help="URL del feed trip updates oppure cartella in cui vengono depositati i file .pb")
+    parser.add_argument("--orari", default="gtfs_bundle",
+                        help="bundle di bundle_gtfs.py oppure Parquet di preprocessing_gtfs.py")
+    parser.add_argument("-o", "--output", default=monitor_path, help="cartella dello stato letto dalla dashboard")
+    parser.add_argument("-i", "--intervallo", type=float, default=INTERVALLO, help="secondi tra due interrogazioni")
+    parser.add_argument("--finestra", type=int, default=15, help="minuti della finestra mobile")
+    parser.add_argument("--max-snapshot", type=int, default=None, help="si ferma dopo N snapshot elaborati")
+    args = parser.parse_args()
+
+    inizio = time.perf_counter()
+    indice = IndiceOrari.carica(args.orari)
+    print(f"Orario in memoria: {len(indice)} passaggi in {time.perf_counter() - inizio:.2f} s")
+    try:
+        asyncio.run(monitora(args.sorgente, indice, args.output, args.intervallo,
+                             pd.Timedelta(minutes=args.finestra), args.max_snapshot))
+    except KeyboardInterrupt:
+        pass
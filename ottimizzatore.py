@@ -0,0 +1,233 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pulp import PULP_CBC_CMD, LpAffineExpression, LpMaximize, LpProblem, LpStatus, LpVariable, lpSum
+from comune import italian_timezone
+from cubo_ritardi import cubo_path, interroga_cubo
+from meteo import meteo_orario, meteo_path
+
+#Parametri del modello prescrittivo (come nel notebook)
+MAX_CORSE_EXTRA = 30
+MAX_PER_LINEA = 7
+SOGLIA_MINIMO = 180
+
+#Penalità del meteo nel coefficiente della funzione obiettivo
+PESO_PIOGGIA = 0.5
+PESO_VENTO = 0.2
+
+#File letti dalla dashboard
+PREFISSO_OUTPUT = "ottimizzazione_dashboard_"
+
+
+#Medie per linea e ora dagli eventi di ritardo (delay in minuti, meteo già unito agli eventi)
+def ritardi_per_linea(df):
+    return df.groupby(["route_id", "hour"], as_index=False)[["delay", "tavg", "prcp", "wspd"]].mean()
+
+
+#Medie per linea e ora lette dal cubo dei ritardi, con il meteo medio della stessa ora nelle giornate richieste
+def ritardi_dal_cubo(radice=cubo_path, date=None, giorni_settimana=None, percorso_meteo=meteo_path, file_meteo=None,
+                     offline=False):
+    cubo = interroga_cubo(radice, per=["route_id", "hour"], date=date, giorni_settimana=giorni_settimana, quantili=())
+    ritardi = pd.DataFrame({"route_id": cubo["route_id"], "hour": cubo["hour"].astype(int), "delay": cubo["media_s"] / 60})
+    if date is None:
+        return ritardi.assign(tavg=np.nan, prcp=0.0, wspd=0.0)
+
+    giorni = pd.to_datetime(sorted(date))
+    meteo = meteo_orario(giorni.min(), giorni.max() + pd.Timedelta(hours=23), percorso_meteo, file_meteo, offline=offline)
+    locale = meteo["time"].dt.tz_convert(italian_timezone)
+    meteo = meteo[locale.dt.strftime("%Y-%m-%d").isin([str(d) for d in date]).to_numpy()]
+    meteo = meteo.groupby(locale.dt.hour.rename("hour"))[["tavg", "prcp", "wspd"]].mean().reset_index()
+    ritardi = ritardi.merge(meteo, on="hour", how="left")
+    return ritardi.fillna({"prcp": 0.0, "wspd": 0.0})
+
+
+#Coefficienti della funzione obiettivo per tutte le coppie (linea, ora) in un'unica operazione vettoriale
+def coefficienti(ritardi, peso_pioggia=PESO_PIOGGIA, peso_vento=PESO_VENTO):
+    return (ritardi["delay"] - peso_pioggia * ritardi["prcp"].fillna(0) - peso_vento * ritardi["wspd"].fillna(0)).to_numpy()
+
+
+#File dell'ultima esecuzione salvata per la dashboard (il nome contiene data e ora dell'esecuzione)
+def ultimo_risultato(cartella="."):
+    file = sorted(glob.glob(os.path.join(cartella, PREFISSO_OUTPUT + "*.csv")))
+    return file[-1] if file else None
+
+
+#Soluzione dell'ultima esecuzione, usata come punto di partenza
+def ultima_soluzione(cartella="."):
+    file = ultimo_risultato(cartella)
+    if file is None:
+        return None
+    return pd.read_csv(file, dtype={"route_id": str})[["route_id", "hour", "extra_trips"]]
+
+
+def _chiavi(df):
+    return df["route_id"].astype(str) + "_" + df["hour"].astype(int).astype(str)
+
+
+#Modello su tutte le coppie (linea, ora). Le coppie con coefficiente non positivo e senza minimo non entrano nel
+#modello (nella soluzione ottima resterebbero a zero). depositi: route_id -> deposito; capacita_depositi: deposito -> corse
+def costruisci_modello(ritardi, max_corse_extra=MAX_CORSE_EXTRA, max_per_linea=MAX_PER_LINEA, soglia_minimo=SOGLIA_MINIMO,
+                       depositi=None, capacita_depositi=None, peso_pioggia=PESO_PIOGGIA, peso_vento=PESO_VENTO):
+    ritardi = ritardi.reset_index(drop=True).assign(coeff=coefficienti(ritardi, peso_pioggia, peso_vento))
+    deposito = None
+    if depositi is not None:
+        deposito = ritardi["route_id"].astype(str).map(pd.Series(depositi).rename(index=str))
+    ritardi["minimo"] = minimi(ritardi, max_corse_extra, soglia_minimo, deposito, capacita_depositi)
+    candidati = ritardi[(ritardi["coeff"] > 0) | (ritardi["minimo"] > 0)]
+    deposito = None if deposito is None else deposito[candidati.index].reset_index(drop=True)
+    candidati = candidati.reset_index(drop=True)
+
+    model = LpProblem(name="Ottimizzazione-frequenze", sense=LpMaximize)
+    #Il minimo di una corsa è il limite inferiore della variabile, senza un vincolo per coppia
+    variabili = [
+        LpVariable(f"extra_trips_{chiave}", lowBound=min(minimo, max_per_linea), upBound=max_per_linea, cat="Integer")
+        for chiave, minimo in zip(_chiavi(candidati), candidati["minimo"])
+    ]
+    model += LpAffineExpression(zip(variabili, candidati["coeff"])), "Massimizzazione Riduzione Ritardi"
+    model += lpSum(variabili) <= max_corse_extra, "Limite Corso Totale"
+
+    if deposito is not None:
+        for nome, posizioni in deposito.groupby(deposito).groups.items():
+            if nome in capacita_depositi:
+                model += lpSum(variabili[i] for i in posizioni) <= capacita_depositi[nome], f"Capacita_deposito_{nome}"
+
+    return model, variabili, candidati
+
+
+#Almeno una corsa alle coppie sopra soglia, dalle più in ritardo, finché restano corse nella flotta e nel deposito
+#della linea: i minimi non possono rendere il modello inammissibile
+def minimi(ritardi, max_corse_extra=MAX_CORSE_EXTRA, soglia_minimo=SOGLIA_MINIMO, deposito=None, capacita_depositi=None):
+    ordine = ritardi["delay"].where(ritardi["delay"] >= soglia_minimo).sort_values(ascending=False, na_position="last")
+    ammesse = ordine.notna()
+    if deposito is not None and capacita_depositi:
+        deposito = deposito[ordine.index]
+        capacita = deposito.map(pd.Series(capacita_depositi, dtype="float64")).fillna(np.inf)
+        #Posizione della coppia tra quelle ammesse dello stesso deposito (le linee senza deposito non hanno limite)
+        posizione = ammesse.astype(int).groupby(deposito.fillna("")).cumsum()
+        ammesse &= posizione <= capacita
+    ammesse &= ammesse.cumsum() <= max_corse_extra
+    return ammesse.reindex(ritardi.index).astype(int)
+
+
+#Valori iniziali dalla soluzione precedente (riportati entro i limiti delle variabili)
+def imposta_warm_start(variabili, candidati, soluzione):
+    iniziali = candidati[["route_id", "hour"]].astype({"route_id": str, "hour": int}).merge(
+        soluzione.astype({"route_id": str, "hour": int}).groupby(["route_id", "hour"], as_index=False)["extra_trips"].sum(),
+        on=["route_id", "hour"], how="left",
+    )["extra_trips"].fillna(0).to_numpy()
+    for variabile, valore in zip(variabili, iniziali):
+        variabile.setInitialValue(int(np.clip(round(valore), variabile.lowBound, variabile.upBound)))
+
+
+#Risoluzione con CBC: rilassamento continuo per il limite superiore, poi problema intero (eventualmente con warm start)
+def risolvi(ritardi, soluzione_precedente=None, limite_secondi=None, msg=False, **parametri):
+    inizio = time.perf_counter()
+    model, variabili, candidati = costruisci_modello(ritardi, **parametri)
+    costruzione = time.perf_counter() - inizio
+
+    model.solve(PULP_CBC_CMD(msg=msg, mip=False))
+    limite_lp = model.objective.value() or 0.0
+
+    warm_start = soluzione_precedente is not None and len(soluzione_precedente) > 0
+    if warm_start:
+        imposta_warm_start(variabili, candidati, soluzione_precedente)
+    inizio = time.perf_counter()
+    model.solve(PULP_CBC_CMD(msg=msg, warmStart=warm_start, timeLimit=limite_secondi))
+    soluzione = time.perf_counter() - inizio
+
+    #Senza una soluzione ammissibile non c'è nulla da salvare per la dashboard
+    if model.status != 1:
+        raise ValueError(f"Ottimizzazione non riuscita: stato {LpStatus[model.status]} "
+                         f"({len(variabili)} variabili, {len(model.constraints)} vincoli)")
+    obiettivo = model.objective.value() or 0.0
+    valori = np.array([v.varValue or 0 for v in variabili])
+    stats = {
+        "coppie": len(ritardi),
+        "variabili": len(variabili),
+        "vincoli": len(model.constraints),
+        "stato": LpStatus[model.status],
+        "obiettivo": obiettivo,
+        "limite_lp": limite_lp,
+        #Gap rispetto al rilassamento continuo (limite superiore dell'ottimo intero)
+        "gap": (limite_lp - obiettivo) / abs(limite_lp) if limite_lp else np.nan,
+        "warm_start": warm_start,
+        "secondi_costruzione": costruzione,
+        "secondi_soluzione": soluzione,
+    }
+    return risultato(candidati, valori), stats
+
+
+#Tabella per la dashboard: solo le coppie con corse extra assegnate
+def risultato(candidati, valori):
+    df = candidati.assign(extra_trips=np.round(valori).astype(float))
+    df["estimated_impact"] = df["extra_trips"] * df["coeff"]
+    df = df[df["extra_trips"] > 0].sort_values("delay", ascending=False)
+    return df[["route_id", "hour", "delay", "prcp", "wspd", "extra_trips", "estimated_impact"]].reset_index(drop=True)
+
+
+def salva_risultato(df, cartella="."):
+    percorso = os.path.join(cartella, f"{PREFISSO_OUTPUT}{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    df.to_csv(percorso, sep=",", index=False)
+    return percorso
+
+
+#Coppie (linea, ora) sintetiche per misurare i tempi sull'intera rete
+def ritardi_benchmark(n_linee=400, ore=range(5, 24), seed=0):
+    rng = np.random.default_rng(seed)
+    linee, ore = np.repeat(np.arange(n_linee).astype(str), len(ore)), np.tile(np.array(ore), n_linee)
+    return pd.DataFrame({
+        "route_id": linee,
+        "hour": ore,
+        "delay": rng.gamma(2.0, 40.0, len(linee)),
+        "tavg": rng.normal(12, 4, len(linee)),
+        "prcp": rng.exponential(1.0, len(linee)),
+        "wspd": rng.normal(9, 3, len(linee)).clip(0),
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Allocazione ottima delle corse extra per linea e ora")
+    sorgente = parser.add_mutually_exclusive_group()
+    sorgente.add_argument("--ritardi", default=None, help="CSV/Parquet con le medie per linea e ora (route_id,hour,delay,prcp,wspd)")
+    sorgente.add_argument("--benchmark", type=int, metavar="N_LINEE", default=None, help="usa N linee sintetiche")
+    parser.add_argument("-c", "--cubo", default=cubo_path, help="cubo dei ritardi (se non si indica --ritardi)")
+    parser.add_argument("--date", nargs="*", default=None, help="giornate di servizio del cubo (YYYY-MM-DD)")
+    parser.add_argument("--depositi", default=None, help="CSV route_id,deposito,capacita con la capacità dei depositi")
+    parser.add_argument("--max-corse", type=int, default=MAX_CORSE_EXTRA, help="corse extra disponibili (flotta)")
+    parser.add_argument("--max-per-linea", type=int, default=MAX_PER_LINEA, help="corse extra massime per linea e ora")
+    parser.add_argument("--soglia", type=float, default=SOGLIA_MINIMO, help="ritardo oltre il quale serve almeno una corsa")
+    parser.add_argument("--limite-secondi", type=int, default=None, help="tempo massimo di soluzione")
+    parser.add_argument("--senza-warm-start", action="store_true", help="non riparte dall'ultima soluzione salvata")
+    parser.add_argument("-o", "--output", default=".", help="cartella di output")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        ritardi = ritardi_benchmark(args.benchmark)
+    elif args.ritardi:
+        ritardi = pd.read_parquet(args.ritardi) if args.ritardi.endswith(".parquet") else pd.read_csv(args.ritardi)
+    else:
+        ritardi = ritardi_dal_cubo(args.cubo, date=args.date)
+
+    depositi = capacita = None
+    if args.depositi:
+        tabella = pd.read_csv(args.depositi, dtype={"route_id": str, "deposito": str})
+        depositi = tabella.set_index("route_id")["deposito"]
+        capacita = tabella.groupby("deposito")["capacita"].first().to_dict()
+
+    precedente = None if args.senza_warm_start or args.benchmark else ultima_soluzione(args.output)
+    try:
+        df, stats = risolvi(ritardi, precedente, args.limite_secondi, max_corse_extra=args.max_corse,
+                            max_per_linea=args.max_per_linea, soglia_minimo=args.soglia,
+                            depositi=depositi, capacita_depositi=capacita)
+    except ValueError as errore:
+        #Nessun file per la dashboard: resta valida l'ultima soluzione salvata
+        sys.exit(str(errore))
+    print(f"{stats['coppie']} coppie (linea, ora), {stats['variabili']} variabili: {stats['stato']}, "
+          f"obiettivo {stats['obiettivo']:.2f}, gap {stats['gap']:.2%} rispetto al rilassamento, "
+          f"costruzione {stats['secondi_costruzione']:.2f} s, soluzione {stats['secondi_soluzione']:.2f} s")
+    if not args.benchmark:
+        print(f"File per la dashboard salvato in: {salva_risultato(df, args.output)}")
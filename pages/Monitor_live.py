@@ -0,0 +1,40 @@
+import streamlit as st
+import pandas as pd
+import plotly.express as px
+from comune import italian_timezone
+from monitor_live import leggi_stato, monitor_path
+
+# Pagina aggiornata automaticamente dallo stato scritto da "python monitor_live.py <url|cartella>"
+
+st.title("Monitor ritardi in tempo reale - Roma")
+aggiornamento = st.sidebar.slider("Aggiornamento (secondi):", 5, 60, 10)
+n_linee = st.sidebar.slider("Linee mostrate:", 5, 50, 20)
+
+@st.fragment(run_every=aggiornamento)
+def pannello_live():
+    linee, storico = leggi_stato(monitor_path)
+    if linee is None:
+        st.info("Nessuno stato trovato: avviare il monitor con \"python monitor_live.py <url_feed|cartella_snapshot>\".")
+        return
+
+    ultimo = storico.iloc[-1]
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Ultimo snapshot", pd.Timestamp(ultimo['snapshot_ts']).tz_convert(italian_timezone).strftime("%H:%M:%S"))
+    col2.metric("Ritardo medio rete (min)", f"{ultimo['media_s'] / 60:.2f}")
+    col3.metric("Latenza (s)", f"{ultimo['latenza_s']:.2f}")
+
+    linee = linee.assign(route_id="Linea " + linee['route_id'], delay=linee['media_s'] / 60)
+    peggiori = linee.nlargest(n_linee, 'delay')
+    st.subheader("Ritardo medio per linea nella finestra mobile")
+    st.plotly_chart(px.bar(peggiori, x="route_id", y="delay", color="quota_oltre_soglia",
+                           labels={"delay": "ritardo medio (min)", "quota_oltre_soglia": "quota > 5 min"}),
+                    use_container_width=True)
+
+    st.subheader("Andamento del ritardo medio di rete")
+    andamento = storico.assign(delay=storico['media_s'] / 60,
+                               snapshot_ts=pd.to_datetime(storico['snapshot_ts']).dt.tz_convert(italian_timezone))
+    st.plotly_chart(px.line(andamento, x="snapshot_ts", y="delay"), use_container_width=True)
+
+    st.dataframe(peggiori[['route_id', 'delay', 'max_s', 'quota_oltre_soglia', 'viaggi', 'n']])
+
+pannello_live()
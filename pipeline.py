@@ -0,0 +1,304 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from comune import scrivi_json
+
+#resource esiste solo sui sistemi Unix: altrove il picco di memoria non viene misurato
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Cartella di default degli artefatti intermedi
+lavoro_path = "pipeline_output"
+
+FASI = ["orari", "bundle", "trip_updates", "ritardi", "cubo", "modello", "ottimizzazione"]
+
+#Scale del benchmark (moltiplicatore dei viaggi del generatore sintetico)
+SCALE = (1, 10, 100)
+
+#Aumento relativo dei tempi o della memoria oltre il quale una fase è segnalata come regressione, purché superi
+#anche una soglia assoluta (le fasi di pochi centesimi di secondo o pochi MB oscillano più del 25%)
+TOLLERANZA = 0.25
+SECONDI_MINIMI = 0.5
+MEMORIA_MINIMA_MB = 20
+
+
+#Artefatti prodotti dalle fasi all'interno della cartella di lavoro
+def percorsi(lavoro):
+    return {
+        "orari": os.path.join(lavoro, "risultato_join_con_stop_times_clean.parquet"),
+        "bundle": os.path.join(lavoro, "gtfs_bundle"),
+        "trip_updates": os.path.join(lavoro, "trip_updates.parquet"),
+        "ritardi": os.path.join(lavoro, "ritardi.parquet"),
+        "ritardi_consistenti": os.path.join(lavoro, "ritardi_consistenti.parquet"),
+        "cubo": os.path.join(lavoro, "cubo_ritardi"),
+        "meteo": os.path.join(lavoro, "meteo_cache", "roma_orario.parquet"),
+        "modello": os.path.join(lavoro, "modello_ritardi.joblib"),
+        "ottimizzazione": os.path.join(lavoro, "ottimizzazione"),
+        "manifest": os.path.join(lavoro, "manifest.json"),
+    }
+
+
+# ========== Fasi: ogni funzione restituisce il numero di righe elaborate ==========
+#I moduli di ogni fase sono importati al suo interno: il processo della fase carica solo le librerie che usa
+#(sklearn, pulp, ...), non quelle di tutte le altre
+
+def fase_orari(cartella_gtfs, output):
+    from preprocessing_gtfs import esegui_procedura
+    return esegui_procedura(cartella_gtfs, output)["righe_lette"]
+
+
+def fase_bundle(cartella_gtfs, orari, output):
+    from bundle_gtfs import costruisci_bundle
+    return costruisci_bundle(cartella_gtfs, output, orari)["stop_times"]
+
+
+def fase_trip_updates(snapshot, output, processi=None):
+    from rome_trip_updates import decodifica_snapshot
+    return decodifica_snapshot(snapshot, output, processi)["righe"]
+
+
+def fase_ritardi(trip_updates, orari, output):
+    from calcolo_ritardi import esegui_calcolo
+    return esegui_calcolo(trip_updates, orari, output)["eventi"]
+
+
+def fase_cubo(ritardi, output, processi=None):
+    from cubo_ritardi import aggiorna_cubo
+    return aggiorna_cubo(ritardi, output, ricostruisci=True, processi=processi)["eventi"]
+
+
+def fase_modello(ritardi, output, percorso_meteo, file_meteo=None, offline=False):
+    from modello_ritardi import addestra_modello, carica_ritardi_con_meteo
+    df = carica_ritardi_con_meteo(ritardi, percorso_meteo, file_meteo, offline)
+    return addestra_modello(df, output)["eventi"]
+
+
+def fase_ottimizzazione(cubo, output, percorso_meteo, file_meteo=None, offline=False):
+    from cubo_ritardi import date_nel_cubo
+    from ottimizzatore import risolvi, ritardi_dal_cubo, salva_risultato, ultima_soluzione
+    os.makedirs(output, exist_ok=True)
+    ritardi = ritardi_dal_cubo(cubo, sorted(date_nel_cubo(cubo)), percorso_meteo=percorso_meteo,
+                               file_meteo=file_meteo, offline=offline)
+    risultato, _ = risolvi(ritardi, ultima_soluzione(output))
+    salva_risultato(risultato, output)
+    return len(ritardi)
+
+
+#Definizione delle fasi: funzione, argomenti, file letti (per l'impronta) e artefatti prodotti
+def definisci_fasi(cartella_gtfs, snapshot, lavoro, file_meteo=None, offline=False, processi=None):
+    from rome_trip_updates import elenca_snapshot
+    p = percorsi(lavoro)
+    gtfs = [os.path.join(cartella_gtfs, f) for f in ("routes.txt", "trips.txt", "stops.txt", "stop_times.txt")]
+    meteo = {"percorso_meteo": p["meteo"], "file_meteo": file_meteo, "offline": offline}
+    return {
+        "orari": (fase_orari, {"cartella_gtfs": cartella_gtfs, "output": p["orari"]}, gtfs, [p["orari"]]),
+        "bundle": (fase_bundle, {"cartella_gtfs": cartella_gtfs, "orari": p["orari"], "output": p["bundle"]},
+                   gtfs + [p["orari"]], [p["bundle"]]),
+        "trip_updates": (fase_trip_updates, {"snapshot": snapshot, "output": p["trip_updates"], "processi": processi},
+                         elenca_snapshot(snapshot), [p["trip_updates"]]),
+        "ritardi": (fase_ritardi, {"trip_updates": p["trip_updates"], "orari": p["orari"], "output": lavoro},
+                    [p["trip_updates"], p["orari"]], [p["ritardi"], p["ritardi_consistenti"]]),
+        "cubo": (fase_cubo, {"ritardi": p["ritardi_consistenti"], "output": p["cubo"], "processi": processi},
+                 [p["ritardi_consistenti"]], [p["cubo"]]),
+        "modello": (fase_modello, {"ritardi": p["ritardi_consistenti"], "output": p["modello"], **meteo},
+                    [p["ritardi_consistenti"]] + ([file_meteo] if file_meteo else []), [p["modello"]]),
+        "ottimizzazione": (fase_ottimizzazione, {"cubo": p["cubo"], "output": p["ottimizzazione"], **meteo},
+                           [p["cubo"]] + ([file_meteo] if file_meteo else []), [p["ottimizzazione"]]),
+    }
+
+
+# ========== Cache degli artefatti ==========
+
+def _file(percorso):
+    if os.path.isdir(percorso):
+        for radice, _, nomi in os.walk(percorso):
+            for nome in sorted(nomi):
+                yield os.path.join(radice, nome)
+    elif os.path.exists(percorso):
+        yield percorso
+
+
+#Impronta degli ingressi di una fase: nome, dimensione e data di modifica dei file, più gli argomenti della fase
+def impronta(ingressi, argomenti):
+    h = hashlib.sha256(json.dumps(argomenti, sort_keys=True, default=str).encode())
+    for percorso in ingressi:
+        for file in sorted(_file(percorso)):
+            info = os.stat(file)
+            h.update(f"{os.path.relpath(file, percorso)}:{info.st_size}:{info.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def leggi_manifest(percorso):
+    if not os.path.exists(percorso):
+        return {}
+    with open(percorso) as f:
+        return json.load(f)
+
+
+# ========== Profilazione ==========
+
+#Campo di /proc/self/status in KB (solo Linux)
+def _stato_processo_kb(campo):
+    try:
+        with open("/proc/self/status") as f:
+            for riga in f:
+                if riga.startswith(campo + ":"):
+                    return int(riga.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _maxrss_kb():
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss è in KB su Linux e in byte su macOS
+    return picco / 1024 if sys.platform == "darwin" else picco
+
+
+#Picco di memoria del processo corrente in KB. Su Linux ru_maxrss sopravvive all'exec e parte dal picco del processo
+#che ha avviato la fase, mentre VmHWM riguarda solo la memoria del processo dopo l'exec
+def _picco_proprio_kb():
+    picco = _stato_processo_kb("VmHWM")
+    return _maxrss_kb() if picco is None else picco
+
+
+#Memoria residente attuale in MB, usata come base prima dell'esecuzione della fase
+def rss_mb():
+    if resource is None:
+        return float("nan")
+    attuale = _stato_processo_kb("VmRSS")
+    return (_maxrss_kb() if attuale is None else attuale) / 1024
+
+
+#Picco di memoria residente (MB) del processo corrente e dei suoi figli (i pool di processi delle fasi)
+def picco_rss_mb():
+    if resource is None:
+        return float("nan")
+    figli = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    figli = figli / 1024 if sys.platform == "darwin" else figli
+    return max(_picco_proprio_kb(), figli) / 1024
+
+
+#Tempo, picco di memoria e memoria aggiunta dalla fase rispetto al processo appena avviato (interprete e pandas)
+def _esegui_misurando(funzione, argomenti):
+    base = rss_mb()
+    inizio = time.perf_counter()
+    righe = funzione(**argomenti)
+    secondi = time.perf_counter() - inizio
+    picco = picco_rss_mb()
+    return righe, secondi, picco, picco - base
+
+
+#Ogni fase gira in un processo nuovo, così il picco di memoria misurato è solo il suo
+def esegui_fase(funzione, argomenti):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(_esegui_misurando, funzione, argomenti).result()
+
+
+#Esecuzione della pipeline: le fasi con ingressi invariati e artefatti presenti vengono saltate
+def esegui_pipeline(cartella_gtfs, snapshot, lavoro=lavoro_path, fasi=None, forza=False,
+                    file_meteo=None, offline=False, processi=None):
+    os.makedirs(lavoro, exist_ok=True)
+    manifest_path = percorsi(lavoro)["manifest"]
+    manifest = leggi_manifest(manifest_path)
+    definizioni = definisci_fasi(cartella_gtfs, snapshot, lavoro, file_meteo, offline, processi)
+
+    profilo = []
+    for nome in FASI if fasi is None else [f for f in FASI if f in fasi]:
+        funzione, argomenti, ingressi, uscite = definizioni[nome]
+        firma = impronta(ingressi, argomenti)
+        precedente = manifest.get(nome, {})
+        if not forza and precedente.get("impronta") == firma and all(os.path.exists(u) for u in uscite):
+            profilo.append({"fase": nome, "stato": "in cache", **precedente["profilo"]})
+            print(f"{nome}: ingressi invariati, fase saltata")
+            continue
+
+        righe, secondi, picco, memoria_fase = esegui_fase(funzione, argomenti)
+        misure = {
+            "secondi": secondi,
+            "picco_rss_mb": picco,
+            "memoria_fase_mb": memoria_fase,
+            "righe": int(righe),
+            "righe_al_secondo": righe / secondi if secondi > 0 else float("nan"),
+        }
+        manifest[nome] = {"impronta": firma, "uscite": uscite, "profilo": misure,
+                          "eseguita_il": pd.Timestamp.now().isoformat(timespec="seconds")}
+        scrivi_json(manifest, manifest_path)
+        profilo.append({"fase": nome, "stato": "eseguita", **misure})
+        print(f"{nome}: {int(righe)} righe in {secondi:.2f} s ({misure['righe_al_secondo']:,.0f} righe/s), "
+              f"picco {picco:.0f} MB (+{memoria_fase:.0f} MB rispetto all'avvio)")
+    return pd.DataFrame(profilo)
+
+
+# ========== Benchmark ==========
+
+#Pipeline completa su dati sintetici a scale crescenti (dati generati una sola volta per scala)
+def benchmark(scale=SCALE, lavoro="benchmark", seed=0, n_snapshot=10, processi=None):
+    from dati_sintetici import genera_dati
+    risultati = []
+    for scala in scale:
+        cartella = os.path.join(lavoro, f"scala_{scala}")
+        dati = genera_dati(os.path.join(cartella, "dati"), scala, seed, n_snapshot)
+        profilo = esegui_pipeline(dati["gtfs"], dati["snapshot"], os.path.join(cartella, "artefatti"),
+                                  forza=True, file_meteo=dati["meteo"], offline=True, processi=processi)
+        risultati.append(profilo.assign(scala=scala))
+    risultati = pd.concat(risultati, ignore_index=True)
+    return risultati[["scala", "fase", "secondi", "picco_rss_mb", "memoria_fase_mb", "righe", "righe_al_secondo"]]
+
+
+#Fasi più lente o più pesanti del riferimento oltre la tolleranza
+#La memoria confrontata è quella aggiunta dalla fase (il picco assoluto comprende interprete e librerie)
+def confronta(risultati, riferimento, tolleranza=TOLLERANZA):
+    memoria = "memoria_fase_mb" if "memoria_fase_mb" in riferimento.columns else "picco_rss_mb"
+    unito = risultati.merge(riferimento, on=["scala", "fase"], suffixes=("", "_riferimento"))
+    unito["variazione_secondi"] = unito["secondi"] / unito["secondi_riferimento"] - 1
+    unito["variazione_memoria"] = unito[memoria] / unito[memoria + "_riferimento"] - 1
+    piu_lente = (unito["variazione_secondi"] > tolleranza) & (unito["secondi"] - unito["secondi_riferimento"] > SECONDI_MINIMI)
+    piu_pesanti = ((unito["variazione_memoria"] > tolleranza)
+                   & (unito[memoria] - unito[memoria + "_riferimento"] > MEMORIA_MINIMA_MB))
+    return unito[piu_lente | piu_pesanti][["scala", "fase", "secondi", "secondi_riferimento", "variazione_secondi",
+                                           memoria, memoria + "_riferimento", "variazione_memoria"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline completa: GTFS statico, trip updates, ritardi, cubo, modelli")
+    parser.add_argument("gtfs", nargs="?", help="cartella del GTFS statico (routes, trips, stops, stop_times)")
+    parser.add_argument("snapshot", nargs="?", help="file .pb, cartella o glob degli snapshot GTFS-RT")
+    parser.add_argument("-o", "--output", default=lavoro_path, help="cartella degli artefatti intermedi")
+    parser.add_argument("--fasi", nargs="*", choices=FASI, default=None, help="fasi da eseguire (default: tutte)")
+    parser.add_argument("--forza", action="store_true", help="esegue le fasi anche se gli ingressi non sono cambiati")
+    parser.add_argument("--file-meteo", default=None, help="CSV meteo orario da usare al posto di meteostat")
+    parser.add_argument("--offline", action="store_true", help="non scarica i dati meteo mancanti")
+    parser.add_argument("-p", "--processi", type=int, default=None, help="processi per decodifica e cubo")
+    parser.add_argument("--benchmark", type=int, nargs="*", metavar="SCALA", default=None,
+                        help=f"esegue la pipeline su dati sintetici alle scale indicate (default: {' '.join(map(str, SCALE))})")
+    parser.add_argument("--riferimento", default=None, help="CSV di un benchmark precedente con cui confrontare i risultati")
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        risultati = benchmark(args.benchmark or SCALE, processi=args.processi)
+        print(risultati.to_string(index=False))
+        file_benchmark = os.path.join("benchmark", f"benchmark_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        risultati.to_csv(file_benchmark, index=False)
+        print(f"\nRisultati salvati in: {file_benchmark}")
+        if args.riferimento:
+            regressioni = confronta(risultati, pd.read_csv(args.riferimento))
+            if len(regressioni):
+                print(f"\nRegressioni rispetto a {args.riferimento}:")
+                print(regressioni.to_string(index=False))
+                sys.exit(1)
+            print(f"\nNessuna regressione rispetto a {args.riferimento}")
+    else:
+        if not args.gtfs or not args.snapshot:
+            parser.error("servono la cartella GTFS e gli snapshot (oppure --benchmark)")
+        profilo = esegui_pipeline(args.gtfs, args.snapshot, args.output, args.fasi, args.forza,
+                                  args.file_meteo, args.offline, args.processi)
+        print(profilo.to_string(index=False))
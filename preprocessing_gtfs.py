@@ -0,0 +1,179 @@
+import argparse
+import os
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+#Cartella contenente i file GTFS statici
+cartella_dati = "dataset"
+nome_output = "risultato_join_con_stop_times_clean.parquet"
+
+#Dimensione dei blocchi letti da stop_times.txt: limita la RAM indipendentemente dalla dimensione del feed
+DIMENSIONE_BLOCCO = 16 * 1024 * 1024
+
+COLONNE_TRIPS = {
+    "route_id": pa.string(),
+    "service_id": pa.string(),
+    "trip_id": pa.string(),
+    "direction_id": pa.int8(),
+    "shape_id": pa.string(),
+}
+
+COLONNE_STOP_TIMES = {
+    "trip_id": pa.string(),
+    "arrival_time": pa.string(),
+    "departure_time": pa.string(),
+    "stop_id": pa.string(),
+    "stop_sequence": pa.int32(),
+    "shape_dist_traveled": pa.float32(),
+}
+
+#Schema del dataset pulito: orari in secondi dall'inizio della giornata di servizio (anche oltre le 24:00:00)
+SCHEMA_OUTPUT = pa.schema([
+    ("route_id", pa.string()),
+    ("service_id", pa.string()),
+    ("trip_id", pa.string()),
+    ("direction_id", pa.int8()),
+    ("shape_id", pa.string()),
+    ("stop_id", pa.string()),
+    ("stop_sequence", pa.int32()),
+    ("arrival_time", pa.int32()),
+    ("departure_time", pa.int32()),
+    ("shape_dist_traveled", pa.float32()),
+])
+
+#Colonne lette come categoriche in pandas
+COLONNE_CATEGORICHE = ["route_id", "service_id", "trip_id", "shape_id", "stop_id"]
+
+_ORARIO_GTFS = r"^\s*(?P<h>\d{1,3}):(?P<m>[0-5]\d):(?P<s>[0-5]\d)\s*$"
+
+
+#Intestazione del file senza BOM (i GTFS esportati da Windows lo includono spesso)
+def _intestazione(percorso):
+    with open(percorso, encoding="utf-8-sig") as f:
+        return [c.strip().strip('"') for c in f.readline().rstrip("\r\n").split(",")]
+
+
+#Lettura a blocchi di un file GTFS, con le sole colonne richieste già tipizzate
+def leggi_gtfs_a_blocchi(percorso, colonne, dimensione_blocco=DIMENSIONE_BLOCCO):
+    nomi = _intestazione(percorso)
+    return pacsv.open_csv(
+        percorso,
+        read_options=pacsv.ReadOptions(column_names=nomi, skip_rows=1, block_size=dimensione_blocco),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=list(colonne),
+            include_missing_columns=True,
+            column_types={nome: tipo for nome, tipo in colonne.items() if nome in nomi},
+            strings_can_be_null=True,
+        ),
+    )
+
+
+def leggi_gtfs(percorso, colonne):
+    return leggi_gtfs_a_blocchi(percorso, colonne).read_all()
+
+
+#Conversione vettoriale di HH:MM:SS in secondi (int32); orari non validi diventano null
+def orario_in_secondi(orari):
+    parti = pc.extract_regex(orari, pattern=_ORARIO_GTFS)
+    ore = pc.cast(pc.struct_field(parti, "h"), pa.int32())
+    minuti = pc.cast(pc.struct_field(parti, "m"), pa.int32())
+    secondi = pc.cast(pc.struct_field(parti, "s"), pa.int32())
+    return pc.add(pc.add(pc.multiply(ore, 3600), pc.multiply(minuti, 60)), secondi)
+
+
+#Viaggi delle linee bus (route_type = 3) dell'agenzia OP1, esclusi i trip_id in formato hash SHA-1
+def carica_trips_filtrati(cartella_dati, agenzia="OP1", route_type=3):
+    routes = leggi_gtfs(f"{cartella_dati}/routes.txt", {
+        "route_id": pa.string(), "agency_id": pa.string(), "route_type": pa.int32(),
+    })
+    maschera = pc.and_(
+        pc.equal(pc.utf8_trim_whitespace(routes["agency_id"]), agenzia),
+        pc.equal(routes["route_type"], route_type),
+    )
+    linee = routes.filter(maschera)["route_id"]
+
+    trips = leggi_gtfs(f"{cartella_dati}/trips.txt", COLONNE_TRIPS)
+    trips = trips.filter(pc.is_in(trips["route_id"], value_set=linee))
+    trips = trips.filter(pc.invert(pc.match_substring_regex(trips["trip_id"], r"^[a-f0-9]{40}$")))
+    return trips.filter(pc.is_valid(trips["trip_id"]))
+
+
+#Filtro, tipizzazione e join di un blocco di stop_times con i viaggi selezionati
+def pulisci_blocco(blocco, trips):
+    blocco = pa.Table.from_batches([blocco])
+    #Il filtro sui viaggi avviene prima della join: le righe scartate non vengono mai materializzate
+    maschera = pc.and_(
+        pc.is_in(blocco["trip_id"], value_set=trips["trip_id"]),
+        pc.is_valid(blocco["stop_id"]),
+    )
+    blocco = blocco.filter(maschera)
+    blocco = blocco.set_column(
+        blocco.schema.get_field_index("arrival_time"), "arrival_time", orario_in_secondi(blocco["arrival_time"])
+    )
+    blocco = blocco.set_column(
+        blocco.schema.get_field_index("departure_time"), "departure_time", orario_in_secondi(blocco["departure_time"])
+    )
+    blocco = blocco.filter(pc.is_valid(blocco["arrival_time"]))
+    unito = blocco.join(trips, keys="trip_id", join_type="inner")
+    return unito.select(SCHEMA_OUTPUT.names).cast(SCHEMA_OUTPUT)
+
+
+#Pipeline completa: stop_times.txt letto a blocchi e scritto direttamente in Parquet
+def esegui_procedura(cartella_dati=cartella_dati, output_path=None, dimensione_blocco=DIMENSIONE_BLOCCO):
+    if output_path is None:
+        output_path = os.path.join(cartella_dati, nome_output)
+
+    inizio = time.perf_counter()
+    trips = carica_trips_filtrati(cartella_dati)
+    lette, scritte = 0, 0
+    with pq.ParquetWriter(output_path, SCHEMA_OUTPUT) as writer:
+        for blocco in leggi_gtfs_a_blocchi(f"{cartella_dati}/stop_times.txt", COLONNE_STOP_TIMES, dimensione_blocco):
+            lette += blocco.num_rows
+            pulito = pulisci_blocco(blocco, trips)
+            if pulito.num_rows:
+                writer.write_table(pulito)
+                scritte += pulito.num_rows
+
+    durata = time.perf_counter() - inizio
+    return {
+        "output": output_path,
+        "trips": trips.num_rows,
+        "righe_lette": lette,
+        "righe_scritte": scritte,
+        "secondi": durata,
+    }
+
+
+#Lettura del dataset pulito con identificativi categorici
+def leggi_stop_times_puliti(percorso, colonne=None, filtri=None):
+    categoriche = [c for c in COLONNE_CATEGORICHE if colonne is None or c in colonne]
+    tabella = pq.read_table(percorso, columns=colonne, filters=filtri, read_dictionary=categoriche)
+    return tabella.to_pandas()
+
+
+#Primo controllo del dataset
+def esplorazione_dati(df):
+    print("\nDimensioni del dataset:", df.shape)
+    print("Colonne del dataset:", df.columns)
+    print("Tipi di dati per ciascuna colonna:")
+    print(df.dtypes)
+    print("\nStatistiche descrittive:")
+    print(df.describe())
+
+    #Analisi dei valori unici nelle colonne chiave
+    print("\nValori unici per 'trip_id':", df['trip_id'].nunique())
+    print("Valori unici per 'stop_id':", df['stop_id'].nunique())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocessing a blocchi del GTFS statico di Roma")
+    parser.add_argument("cartella", nargs="?", default=cartella_dati, help="cartella con routes.txt, trips.txt e stop_times.txt")
+    parser.add_argument("-o", "--output", default=None, help=f"file Parquet di output (default: <cartella>/{nome_output})")
+    args = parser.parse_args()
+
+    stats = esegui_procedura(args.cartella, args.output)
+    print(f"{stats['righe_scritte']} righe su {stats['righe_lette']} ({stats['trips']} viaggi) in {stats['secondi']:.2f} s")
+    print(f"\nDataset pulito salvato in: {stats['output']}")
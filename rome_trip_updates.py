@@ -1,45 +1,172 @@
-from gtfs_realtime_pb2 import FeedMessage
-from datetime import datetime, timezone
-import pytz
-import pandas as pd  
-
-# Percorso dei file
-file_path = "C:/Users/C.Marino/Desktop/rome_trip_updates.pb"
-output_txt_path = "C:/Users/C.Marino/Desktop/trip_updates.txt"
-
-#Fuso orario italiano
-italian_timezone = pytz.timezone("Europe/Rome")
-
-
-feed = FeedMessage()
-
-# Leggi il file .pb
-with open(file_path, "rb") as f:
-    feed.ParseFromString(f.read())
-
-# Apre il file .txt per scrivere i dati
-with open(output_txt_path, mode='w') as txt_file:
-    # Scrive l'intestazione
-    txt_file.write("trip_id,stop_id,arrival_date,arrival_time,arrival_time_utc\n")
-    
-    # Estrae i dati e scrive nel file
-    for entity in feed.entity:
-        if entity.trip_update:
-            trip_id = entity.trip_update.trip.trip_id
-            for stop_time_update in entity.trip_update.stop_time_update:
-                stop_id = stop_time_update.stop_id
-                arrival_time = stop_time_update.arrival.time  
-
-                # Controlla e converte il timestamp
-                if arrival_time > 0:
-                    
-                    
-                    dt_utc = datetime.fromtimestamp(arrival_time, timezone.utc)
-                    dt_local = dt_utc.astimezone(italian_timezone)
-                    arrival_date = dt_local.strftime('%Y-%m-%d')
-                    arrival_time_only = dt_local.strftime('%H:%M:%S')
-
-                    # Scrive i dati nel file, includendo il timestamp e l'ora locale
-                    txt_file.write(f"{trip_id},{stop_id},{arrival_date},{arrival_time_only}\n")
-
-print(f"Dati esportati correttamente nel file TXT: {output_txt_path}")
+from gtfs_realtime_pb2 import FeedMessage
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from archivio_trip_updates import aggiungi_snapshot, compatta_archivio
+from comune import italian_timezone
+
+# Percorsi di default
+file_path = "rome_trip_updates.pb"
+output_path = "trip_updates.parquet"
+
+#Schema colonnare dell'output
+SCHEMA_TRIP_UPDATES = pa.schema([
+    ("snapshot_ts", pa.timestamp("s", tz="UTC")),
+    ("trip_id", pa.string()),
+    ("route_id", pa.string()),
+    ("start_date", pa.string()),
+    ("stop_id", pa.string()),
+    ("stop_sequence", pa.int32()),
+    ("arrival_date", pa.string()),
+    ("arrival_time", pa.string()),
+    ("arrival_time_utc", pa.timestamp("s", tz="UTC")),
+])
+
+
+#Elenco dei file .pb a partire da un file, una cartella o un glob
+def elenca_snapshot(sorgente):
+    if os.path.isdir(sorgente):
+        files = glob.glob(os.path.join(sorgente, "*.pb"))
+    else:
+        files = glob.glob(sorgente)
+    return sorted(files)
+
+
+#Decodifica di un FeedMessage serializzato (file o risposta HTTP) in colonne Python (una lista per campo)
+def estrai_colonne_da_bytes(dati):
+    feed = FeedMessage()
+    feed.ParseFromString(dati)
+
+    snapshot_ts = feed.header.timestamp
+    trip_ids, route_ids, start_dates, stop_ids, sequenze, arrivi = [], [], [], [], [], []
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        trip = entity.trip_update.trip
+        for stop_time_update in entity.trip_update.stop_time_update:
+            arrival_time = stop_time_update.arrival.time
+            #Scarta gli aggiornamenti senza orario di arrivo
+            if arrival_time > 0:
+                trip_ids.append(trip.trip_id)
+                route_ids.append(trip.route_id)
+                start_dates.append(trip.start_date)
+                stop_ids.append(stop_time_update.stop_id)
+                sequenze.append(stop_time_update.stop_sequence)
+                arrivi.append(arrival_time)
+
+    return {
+        "snapshot_ts": [snapshot_ts] * len(arrivi),
+        "trip_id": trip_ids,
+        "route_id": route_ids,
+        "start_date": start_dates,
+        "stop_id": stop_ids,
+        "stop_sequence": sequenze,
+        "arrival_time_utc": arrivi,
+    }
+
+
+#Decodifica di un singolo snapshot salvato su file
+def estrai_colonne(percorso):
+    with open(percorso, "rb") as f:
+        return estrai_colonne_da_bytes(f.read())
+
+
+#Conversione vettoriale dei timestamp in data e ora locali (Europe/Rome)
+def converti_orari(df):
+    utc = pd.to_datetime(df["arrival_time_utc"], unit="s", utc=True)
+    locale = utc.dt.tz_convert(italian_timezone).dt.tz_localize(None).to_numpy().astype("datetime64[s]")
+    #'YYYY-MM-DDTHH:MM:SS' formattato in C, poi tagliato senza passare per strftime riga per riga
+    testo = pa.array(np.datetime_as_string(locale))
+    df["arrival_date"] = pc.utf8_slice_codeunits(testo, 0, 10).to_numpy(zero_copy_only=False)
+    df["arrival_time"] = pc.utf8_slice_codeunits(testo, 11, 19).to_numpy(zero_copy_only=False)
+    df["arrival_time_utc"] = utc
+    df["snapshot_ts"] = pd.to_datetime(df["snapshot_ts"], unit="s", utc=True)
+    return df
+
+
+#Decodifica di un gruppo di snapshot in un'unica tabella Arrow (eseguita nei processi figli)
+def decodifica_batch(percorsi):
+    colonne = {}
+    for percorso in percorsi:
+        for nome, valori in estrai_colonne(percorso).items():
+            colonne.setdefault(nome, []).extend(valori)
+    df = converti_orari(pd.DataFrame(colonne, columns=[
+        "snapshot_ts", "trip_id", "route_id", "start_date", "stop_id", "stop_sequence", "arrival_time_utc"
+    ]))
+    return pa.Table.from_pandas(df, schema=SCHEMA_TRIP_UPDATES, preserve_index=False)
+
+
+def _dividi(files, dimensione):
+    return [files[i:i + dimensione] for i in range(0, len(files), dimensione)]
+
+
+#Decodifica di tutti gli snapshot con un pool di processi, scrivendo batch colonnari
+#e/o unendoli all'archivio deduplicato delle previsioni
+def decodifica_snapshot(sorgente, output_path=output_path, processi=None, snapshot_per_batch=20,
+                        archivio=None, politica="ultima"):
+    files = elenca_snapshot(sorgente)
+    if not files:
+        raise FileNotFoundError(f"Nessuno snapshot .pb trovato in: {sorgente}")
+
+    inizio = time.perf_counter()
+    righe = 0
+    archiviate = 0
+    csv = output_path is not None and output_path.endswith((".txt", ".csv"))
+    writer = None if output_path is None or csv else pq.ParquetWriter(output_path, SCHEMA_TRIP_UPDATES)
+    try:
+        with ProcessPoolExecutor(max_workers=processi) as pool:
+            #map mantiene l'ordine degli snapshot
+            for tabella in pool.map(decodifica_batch, _dividi(files, snapshot_per_batch)):
+                if csv:
+                    #Formato testuale compatibile con il vecchio trip_updates.txt
+                    tabella.to_pandas().to_csv(output_path, mode="a" if righe else "w", header=not righe, index=False)
+                elif writer is not None:
+                    writer.write_table(tabella)
+                if archivio is not None:
+                    archiviate += aggiungi_snapshot(tabella, archivio, politica, compatta=False)
+                righe += tabella.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    #Compattazione una sola volta al termine, non a ogni batch
+    compattate = compatta_archivio(archivio, politica) if archivio is not None else 0
+
+    durata = time.perf_counter() - inizio
+    statistiche = {
+        "snapshot": len(files),
+        "righe": righe,
+        "archiviate": archiviate,
+        "partizioni_compattate": compattate,
+        "secondi": durata,
+        "righe_al_secondo": righe / durata if durata > 0 else float("inf"),
+    }
+    return statistiche
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decodifica degli snapshot GTFS-RT trip updates di Roma")
+    parser.add_argument("sorgente", nargs="?", default=file_path, help="file .pb, cartella o glob di snapshot")
+    parser.add_argument("-o", "--output", default=None, help="file di output (.parquet oppure .txt/.csv)")
+    parser.add_argument("-p", "--processi", type=int, default=None, help="numero di processi (default: tutti i core)")
+    parser.add_argument("-b", "--batch", type=int, default=20, help="snapshot per batch")
+    parser.add_argument("-a", "--archivio", default=None, help="cartella dell'archivio deduplicato (archivio_trip_updates.py)")
+    parser.add_argument("--politica", choices=["ultima", "prima"], default="ultima",
+                        help="previsione da conservare in archivio per (trip_id, stop_id)")
+    args = parser.parse_args()
+
+    #Senza archivio l'output su file resta quello di default
+    output = args.output if args.output or args.archivio else output_path
+    stats = decodifica_snapshot(args.sorgente, output, args.processi, args.batch, args.archivio, args.politica)
+    if output:
+        print(f"Dati esportati correttamente nel file: {output}")
+    if args.archivio:
+        print(f"{stats['archiviate']} nuove previsioni archiviate in: {args.archivio}")
+    print(f"{stats['snapshot']} snapshot, {stats['righe']} righe in {stats['secondi']:.2f} s "
+          f"({stats['righe_al_secondo']:,.0f} righe/s)")